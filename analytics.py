@@ -0,0 +1,95 @@
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import telemetry
+
+BUCKET = 3600
+ALL_TIME = 0
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS rollups (
+    guild_id INTEGER NOT NULL,
+    bucket   INTEGER NOT NULL,
+    metric   TEXT    NOT NULL,
+    key      TEXT    NOT NULL,
+    count    INTEGER NOT NULL,
+    total    REAL    NOT NULL,
+    PRIMARY KEY (guild_id, bucket, metric, key)
+) WITHOUT ROWID
+'''
+
+UPSERT = '''
+INSERT INTO rollups (guild_id, bucket, metric, key, count, total) VALUES (?, ?, ?, ?, 1, ?)
+ON CONFLICT (guild_id, bucket, metric, key) DO UPDATE SET count = count + 1, total = total + excluded.total
+'''
+
+class Analytics:
+    """Per-guild voting aggregates, kept as hourly and all-time rollups in a local SQLite database.
+
+    Every event increments its rollup rows in place, so a summary reads at most one row per hour of the window for
+    each metric rather than the event history. All database work happens on one dedicated thread."""
+
+    def __init__(self, loop, path='analytics.db', retention=30 * 86400):
+        self.loop = loop
+        self.path = path
+        self.retention = retention
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='analytics')
+        self.db = None
+        self.pruned = 0
+
+    def _connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute(SCHEMA)
+
+        return self.db
+
+    def record(self, guild_id, metric, key='', value=0.0):
+        """Counts an event towards its guild's rollups without waiting for the write"""
+        future = self.loop.run_in_executor(self.executor, self._record, guild_id, metric, str(key), value, time.time())
+        future.add_done_callback(self._report)
+
+    @staticmethod
+    def _report(future):
+        if not future.cancelled() and (e := future.exception()):
+            telemetry.errors.inc(where='analytics')
+            print('Failed to record analytics.', e)
+
+    def _record(self, guild_id, metric, key, value, now):
+        db = self._connect()
+        bucket = int(now // BUCKET * BUCKET)
+        with db:
+            db.executemany(UPSERT, [(guild_id, bucket, metric, key, value), (guild_id, ALL_TIME, metric, key, value)])
+
+            if now - self.pruned > BUCKET:
+                self.pruned = now
+                db.execute('DELETE FROM rollups WHERE bucket != ? AND bucket < ?', (ALL_TIME, now - self.retention))
+
+    async def summary(self, guild_id, seconds):
+        """{metric: {key: (count, total)}} over the last `seconds`, and the same for all time"""
+        return await self.loop.run_in_executor(self.executor, self._summary, guild_id, time.time() - seconds)
+
+    def _summary(self, guild_id, since):
+        db = self._connect()
+        window, all_time = {}, {}
+        rows = db.execute('''
+            SELECT bucket = ?, metric, key, SUM(count), SUM(total) FROM rollups
+            WHERE guild_id = ? AND (bucket = ? OR bucket >= ?)
+            GROUP BY bucket = ?, metric, key
+        ''', (ALL_TIME, guild_id, ALL_TIME, since // BUCKET * BUCKET, ALL_TIME))
+
+        for is_all_time, metric, key, count, total in rows:
+            (all_time if is_all_time else window).setdefault(metric, {})[key] = (count, total)
+
+        return window, all_time
+
+    def close(self):
+        def close_db():
+            if self.db is not None:
+                self.db.close()
+
+        self.executor.submit(close_db)
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,76 @@
+import asyncio
+import time
+from functools import partial
+
+import rules
+
+TWEPOCH = 1288834974657  # Twitter's snowflake epoch, in milliseconds
+SEARCH = 'search/tweets'
+PAGE_SIZE = 100
+
+def snowflake_at(timestamp):
+    """The lowest Tweet id that could have been created at `timestamp`"""
+    return (int(timestamp * 1000) - TWEPOCH) << 22
+
+def query(terms):
+    # Retweets are dropped by the stream listener as well; leaving them out of the search saves pages
+    return f'({rules.search_query(terms)}) -filter:retweets'
+
+def normalize(status, me):
+    """Shapes a search result like a status from the stream, or returns None for one the stream would have dropped"""
+    if status.in_reply_to_status_id or hasattr(status, 'retweeted_status') or status.author.screen_name == me:
+        return None
+
+    # tweet_mode=extended puts the whole text in full_text rather than text/extended_tweet
+    status.text = getattr(status, 'full_text', getattr(status, 'text', ''))
+    status.truncated = False
+
+    status.quoted_status = getattr(status, 'quoted_status', None)
+    if status.quoted_status:
+        quoted = status.quoted_status
+        quoted.extended_tweet = {'full_text': getattr(quoted, 'full_text', getattr(quoted, 'text', ''))}
+
+    return status
+
+def page_budget(api, max_pages):
+    limits = getattr(api, 'rate_limits', {}).get(SEARCH)
+    if not limits or limits['reset'] <= time.time():
+        return max_pages
+
+    return min(max_pages, limits['remaining'])
+
+async def search_since(loop, api, terms, since_id, slices=4, max_pages=20):
+    """Tweets matching `terms` posted after `since_id`, oldest first.
+
+    The gap up to now is cut into equal time slices (Tweet ids are timestamps shifted left by 22 bits), which are
+    paged through concurrently while sharing what's left of the search rate limit."""
+    until_id = snowflake_at(time.time())
+    budget = [page_budget(api, max_pages)]
+    if until_id <= since_id or budget[0] <= 0:
+        return []
+
+    q = query(terms)
+    step = (until_id - since_id) // slices + 1
+
+    async def fetch(lower, upper):
+        found = []
+        max_id = upper
+        while budget[0] > 0 and max_id > lower:
+            budget[0] -= 1
+            results = await loop.run_in_executor(None, partial(
+                api.search_tweets, q, since_id=lower, max_id=max_id, count=PAGE_SIZE,
+                result_type='recent', tweet_mode='extended', include_entities=False
+            ))
+            found.extend(results)
+            if len(results) < PAGE_SIZE:
+                break
+
+            max_id = min(status.id for status in results) - 1
+
+        return found
+
+    pages = await asyncio.gather(*(fetch(since_id + i * step, min(since_id + (i + 1) * step, until_id))
+                                   for i in range(slices)))
+
+    statuses = {status.id: status for page in pages for status in page}
+    return [statuses[tweet_id] for tweet_id in sorted(statuses)]
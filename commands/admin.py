@@ -49,7 +49,7 @@ class Admin(commands.Cog):
             channel_permissions = self.bot.config[ctx.guild.id]['allowed']['channels']
             if channel.id not in channel_permissions:
                 channel_permissions.append(channel.id)
-                self.bot.save_config()
+                self.bot.save_config(ctx.guild.id)
 
             embed = discord.Embed(color=discord.Color.dark_blue(), title="Authorized Channel",
                                   description="Responding to commands in this channel.")
@@ -84,7 +84,7 @@ class Admin(commands.Cog):
             allow_config['users'].append(target.id)
             target_type = 'User'
 
-        self.bot.save_config()
+        self.bot.save_config(ctx.guild.id)
         embed = discord.Embed(color=discord.Color.dark_blue(), title=f"Authorized {target_type}",
                               description=f"{target.name} can now interact with me.")
         await ctx.channel.send(embed=embed)
@@ -100,7 +100,7 @@ class Admin(commands.Cog):
     @set.command('votes')
     async def votes(self, ctx: commands.Context, votes: int):
         self.bot.config[ctx.guild.id]['votes_needed'] = votes
-        self.bot.save_config()
+        self.bot.save_config(ctx.guild.id)
 
         embed = discord.Embed(color=discord.Color.dark_blue(), title="Configured Vote Counts",
                               description=f"Vote Threshold set at {votes}")
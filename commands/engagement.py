@@ -0,0 +1,113 @@
+import time
+from collections import deque
+from functools import partial
+
+import discord
+from discord.ext import commands, tasks
+from mooBird import MooBird
+import telemetry
+
+class Engagement(commands.Cog):
+    """Keeps the reply/retweet/like counts of posted Tweets up to date on their Discord result messages"""
+    batch_size = 100  # statuses/lookup accepts up to 100 ids per request
+
+    def __init__(self, bot):
+        self.bot = bot  # type: MooBird
+        self.tracked = {}
+        self.spent = deque()
+
+        options = self.bot.settings.get('engagement', {})
+        self.budget = options.get('requests_per_hour', 60)
+        self.max_age = options.get('max_age', 7 * 86400)
+
+        self.refresh.start()
+
+    def cog_unload(self):
+        self.refresh.cancel()
+
+    def track(self, guild_id, status, message: discord.Message):
+        now = time.time()
+        self.tracked[status.id] = {
+            'guild_id': guild_id,
+            'message' : message,
+            'content' : message.content,
+            'posted'  : now,
+            'next'    : now + self.interval(0),
+            'counts'  : None
+        }
+
+    @staticmethod
+    def interval(age):
+        # Fresh Tweets gather most of their engagement early; back off to every 6 hours as they age
+        return min(max(120, age / 4), 21600)
+
+    def _spend(self):
+        now = time.time()
+        while self.spent and now - self.spent[0] > 3600:
+            self.spent.popleft()
+
+        if len(self.spent) >= self.budget:
+            return False
+
+        self.spent.append(now)
+        return True
+
+    @tasks.loop(minutes=1)
+    async def refresh(self):
+        now = time.time()
+        for tweet_id in [k for k, v in self.tracked.items() if now - v['posted'] > self.max_age]:
+            del self.tracked[tweet_id]
+
+        # One lookup per account covers every guild posting through it
+        due = {}
+        for tweet_id, entry in sorted(self.tracked.items(), key=lambda item: item[1]['next']):
+            if entry['next'] > now or not (api := self.bot.twitterApi.get(entry['guild_id'])):
+                continue
+
+            due.setdefault(telemetry.account_of(api), (api, []))[1].append(tweet_id)
+
+        for api, tweet_ids in due.values():
+            for i in range(0, len(tweet_ids), self.batch_size):
+                if not self._spend():
+                    return
+
+                chunk = tweet_ids[i:i + self.batch_size]
+                try:
+                    statuses = await self.bot.loop.run_in_executor(None, partial(api.lookup_statuses, chunk))
+                except Exception as e:
+                    telemetry.errors.inc(where='engagement')
+                    print(e)
+                    continue
+
+                found = {status.id: status for status in statuses}
+                for tweet_id in chunk:
+                    if (entry := self.tracked.get(tweet_id)) is None:
+                        continue
+
+                    if (status := found.get(tweet_id)) is None:
+                        # Deleted or otherwise unavailable
+                        del self.tracked[tweet_id]
+                        continue
+
+                    entry['next'] = now + self.interval(now - entry['posted'])
+                    await self._update(entry, status)
+
+    async def _update(self, entry, status):
+        counts = (getattr(status, 'reply_count', '-'), status.retweet_count, status.favorite_count)
+        if counts == entry['counts']:
+            return
+
+        entry['counts'] = counts
+        interactions = self.bot.get_cog('Twitter').interaction_string.format(*counts)
+        try:
+            await entry['message'].edit(content=f"{entry['content']}\n{interactions}",
+                                        allowed_mentions=discord.AllowedMentions(users=False))
+        except discord.NotFound:
+            del self.tracked[status.id]
+
+    @refresh.before_loop
+    async def before_refresh(self):
+        await self.bot.wait_until_ready()
+
+def setup(bot):
+    bot.add_cog(Engagement(bot))
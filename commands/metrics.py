@@ -0,0 +1,35 @@
+from aiohttp import web
+from discord.ext import commands
+from mooBird import MooBird
+import telemetry
+
+class Metrics(commands.Cog):
+    """Serves telemetry in the Prometheus text format when `metrics.enabled` is set in config.yaml"""
+
+    def __init__(self, bot):
+        self.bot = bot  # type: MooBird
+        self.runner = None
+
+        telemetry.open_candidates.set_function(lambda: len(self.bot.tweet_candidates))
+
+        options = self.bot.settings.get('metrics', {})
+        if options.get('enabled'):
+            self.bot.loop.create_task(self._serve(options.get('host', '127.0.0.1'), options.get('port', 9100)))
+
+    def cog_unload(self):
+        if self.runner:
+            self.bot.loop.create_task(self.runner.cleanup())
+
+    async def _serve(self, host, port):
+        app = web.Application()
+        app.router.add_get('/metrics', self.scrape)
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+
+    async def scrape(self, request):
+        return web.Response(text=telemetry.registry.render(), content_type='text/plain', charset='utf-8')
+
+def setup(bot):
+    bot.add_cog(Metrics(bot))
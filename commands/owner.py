@@ -1,8 +1,15 @@
+import io
+import threading
+import time
+import discord
 from discord.ext import commands
+from profiler import SamplingProfiler, TracingProfiler, run_profiler
+from tracing import tracer
 
 class Owner(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.profiling = False
 
     # Hidden means it won't show up on the default help.
     @commands.command(name='load', hidden=True)
@@ -45,5 +52,100 @@ class Owner(commands.Cog):
         else:
             await ctx.message.add_reaction('👍')
 
+    @commands.command(name='timings', hidden=True)
+    @commands.is_owner()
+    async def owner_timings(self, ctx):
+        """Shows how long each extension took to import and set up when it was last loaded.
+        Extensions deferred by `lazy_load` are listed until their first use."""
+
+        rows = [f"{'import ms':>9} {'setup ms':>9}  extension"]
+        for name, timings in sorted(self.bot.extension_timings.items()):
+            rows.append(f"{timings.get('import', 0) * 1000:>9.1f} {timings.get('setup', 0) * 1000:>9.1f}  {name}")
+
+        for name in sorted(self.bot.deferred):
+            rows.append(f"{'-':>9} {'-':>9}  {name} (deferred)")
+
+        output = '\n'.join(rows)
+        await ctx.send(f'```\n{output}\n```')
+
+    @commands.command(name='trace', hidden=True)
+    @commands.is_owner()
+    async def owner_trace(self, ctx, key: str):
+        """Shows the stage breakdown of a traced candidate.
+        Accepts a trace id, or the id of a vote or stream message."""
+
+        if not (trace_id := tracer.resolve(key)) or not (spans := tracer.breakdown(trace_id)):
+            return await ctx.send(f'**`ERROR:`** No trace recorded for `{key}`')
+
+        rows = [f"{'+ms':>8} {'ms':>8}  stage"]
+        for name, offset, duration, status in spans:
+            flag = '' if status == 'ok' else f'  [{status}]'
+            rows.append(f'{offset * 1000:>8.1f} {duration * 1000:>8.1f}  {name}{flag}')
+
+        output = '\n'.join(rows)
+        if len(output) > 1900:
+            output = output[:1900] + '\n...'
+
+        await ctx.send(f'Trace `{trace_id}`\n```\n{output}\n```')
+
+    @commands.command(name='lag', hidden=True)
+    @commands.is_owner()
+    async def owner_lag(self, ctx, incident: int = None):
+        """Lists recent event loop stalls.
+        Pass an incident number to see the stack captured for it."""
+
+        watchdog = self.bot.watchdog
+        incidents = list(reversed(watchdog.incidents))
+
+        if incident is not None:
+            if not 0 < incident <= len(incidents):
+                return await ctx.send(f'**`ERROR:`** No incident #{incident}')
+
+            stack = ''.join(incidents[incident - 1]['stack'])[-1900:]
+            return await ctx.send(f'```\n{stack}\n```')
+
+        rows = [f'Current lag: {watchdog.lag * 1000:.1f} ms, threshold {watchdog.threshold * 1000:.0f} ms']
+        for i, info in enumerate(incidents[:10], start=1):
+            ago = int(time.time() - info['time'])
+            rows.append(f"#{i} {ago}s ago  {info['duration'] * 1000:.0f} ms  {info['handler']}  guild: {info['guild'] or 'n/a'}")
+
+        if not incidents:
+            rows.append('No stalls recorded.')
+
+        output = '\n'.join(rows)
+        await ctx.send(f'```\n{output}\n```')
+
+    @commands.command(name='profile', hidden=True)
+    @commands.is_owner()
+    async def owner_profile(self, ctx, seconds: int = 10, mode: str = 'sample', limit: int = 15):
+        """Profiles the running bot and DMs the results.
+        Modes: `sample` (low overhead, folded stacks for flamegraph.pl/speedscope) or `cprofile` (.prof file)"""
+
+        if self.profiling:
+            return await ctx.send('**`ERROR:`** A profile is already running')
+
+        if mode not in ('sample', 'cprofile'):
+            return await ctx.send('**`ERROR:`** Mode must be `sample` or `cprofile`')
+
+        seconds = max(1, min(seconds, 300))
+        profiler = SamplingProfiler(threading.get_ident()) if mode == 'sample' else TracingProfiler()
+
+        self.profiling = True
+        await ctx.message.add_reaction('⏱️')
+        try:
+            await run_profiler(profiler, seconds)
+        finally:
+            self.profiling = False
+
+        if mode == 'sample':
+            file = discord.File(io.BytesIO(profiler.folded().encode()), filename='profile.folded.txt')
+            summary = f'{profiler.samples} samples over {seconds}s'
+        else:
+            file = discord.File(io.BytesIO(profiler.dump()), filename='profile.prof')
+            summary = f'cProfile over {seconds}s'
+
+        table = profiler.top(limit)[:1800]
+        await ctx.author.send(f'{summary}\n```\n{table}\n```', file=file)
+
 def setup(bot):
     bot.add_cog(Owner(bot))
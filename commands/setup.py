@@ -18,8 +18,7 @@ class Setup(commands.Cog, description="Initial Setup Commands"):
 
     @commands.Cog.listener()
     async def on_ready(self):
-        for guild in self.bot.guilds:
-            await self._warn_no_creds(guild)
+        await asyncio.gather(*(self._warn_no_creds(guild) for guild in self.bot.guilds))
 
     @commands.Cog.listener()
     async def on_guild_join(self, guild: discord.Guild):
@@ -46,8 +45,13 @@ class Setup(commands.Cog, description="Initial Setup Commands"):
             return await ctx.message.add_reaction('❌')
 
     async def _warn_no_creds(self, guild):
+        if validation := self.bot.validations.get(guild.id):
+            await validation
+
         if not (credentials := self.bot.config.get(guild.id, {}).get('credentials')):
-            self.bot.create_config(guild.id)
+            # Rejected credentials leave the rest of the server's settings alone
+            if guild.id not in self.bot.config:
+                self.bot.create_config(guild.id)
 
             channel = discord.utils.find(lambda m: 'general' in m.name, guild.text_channels)
             if not channel:
@@ -111,7 +115,7 @@ class Setup(commands.Cog, description="Initial Setup Commands"):
                 'API Secret': api_secret
             }
 
-            self.bot.save_config()
+            self.bot.save_config(guild_id)
             await prompt.delete()
             await self._send_auth_step(ctx)
         except asyncio.TimeoutError:
@@ -171,10 +175,11 @@ class Setup(commands.Cog, description="Initial Setup Commands"):
                 'Access Secret': access_secret
             })
 
-            self.bot.save_config()
+            self.bot.save_config(guild_id)
 
             if api := self.bot.validate_credentials(self.bot.config[guild_id]['credentials']):
                 self.bot.twitterApi[guild_id] = api
+                self.bot.credential_cache.save()
                 embed = discord.Embed(color=discord.Color.green(), title=f'Welcome, @{api.me().screen_name}!',
                                       description="Your account has been confirmed, and you're ready to start Tweeting!\n\n"
                                                   "Send `help` for more information on how to operate this, "
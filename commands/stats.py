@@ -0,0 +1,62 @@
+import discord
+from discord.ext import commands
+from mooBird import MooBird
+
+class Stats(commands.Cog, name='Stats', description="Voting Analytics"):
+    """Answers from the analytics rollups, so the cost doesn't grow with the guild's history"""
+
+    def __init__(self, bot):
+        self.bot = bot  # type: MooBird
+
+    @staticmethod
+    def _count(rollup, metric, key=None):
+        keys = rollup.get(metric, {})
+        if key is not None:
+            return keys.get(key, (0, 0))[0]
+
+        return sum(count for count, _ in keys.values())
+
+    @staticmethod
+    def _top(rollup, metric, limit=5):
+        return sorted(rollup.get(metric, {}).items(), key=lambda item: item[1][0], reverse=True)[:limit]
+
+    @commands.command(help='Voting and stream activity over the last [days] days')
+    @commands.guild_only()
+    async def stats(self, ctx: commands.Context, days: int = 7):
+        days = max(1, min(days, 30))
+        window, all_time = await self.bot.analytics.summary(ctx.guild.id, days * 86400)
+
+        embed = discord.Embed(color=discord.Color.dark_blue(), title=f'Activity in the last {days} days')
+
+        passed, pass_seconds = window.get('passed', {}).get('', (0, 0))
+        proposals = (f"Proposed: {self._count(window, 'proposed')}\n"
+                     f"Passed: {passed}\n"
+                     f"Voted down: {self._count(window, 'failed')}\n"
+                     f"Timed out: {self._count(window, 'timed_out')}")
+        if passed:
+            proposals += f"\nAverage time to pass: {pass_seconds / passed / 60:.1f} min"
+        embed.add_field(name='Tweet Votes', value=proposals)
+
+        streamed = self._count(window, 'streamed')
+        likes = self._count(window, 'interaction', 'favorite')
+        stream = (f"Posted: {streamed}\n"
+                  f"Liked: {likes}" + (f" ({likes / streamed:.0%})" if streamed else '') + "\n"
+                  f"Muted: {self._count(window, 'interaction', 'mute')}\n"
+                  f"Cowmoonity: {self._count(window, 'interaction', 'cowmoonity')}\n"
+                  f"Expired: {self._count(window, 'expired')}")
+        embed.add_field(name='Stream', value=stream)
+
+        if voters := self._top(window, 'vote'):
+            embed.add_field(name='Most Active Voters', inline=False,
+                            value='\n'.join(f"<@{user_id}>: {count} reactions" for user_id, (count, _) in voters))
+
+        if terms := self._top(window, 'mute_term'):
+            embed.add_field(name='Terms Leading to Mutes', inline=False,
+                            value='\n'.join(f"`{term or 'unknown'}`: {count}" for term, (count, _) in terms))
+
+        embed.set_footer(text=f"All time: {self._count(all_time, 'proposed')} proposed, "
+                              f"{self._count(all_time, 'passed')} passed, {self._count(all_time, 'streamed')} streamed")
+        await ctx.send(embed=embed)
+
+def setup(bot):
+    bot.add_cog(Stats(bot))
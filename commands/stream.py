@@ -1,9 +1,14 @@
-import json
+import asyncio
+import random
 import shlex
+import time
 import discord
 from discord.ext import commands
-from tweepy import asynchronous
 from mooBird import MooBird
+import backfill
+import relevance
+import rules
+import telemetry
 
 def can_stream():
     def predicate(ctx):
@@ -14,11 +19,22 @@ def can_stream():
 class Stream(commands.Cog, name='Streams', description="Twitter Search Stream"):
     def __init__(self, bot):
         self.bot = bot  # type: MooBird
+        self.resumed = False
+        self.filtered = None
 
         if self.bot.is_ready():
-            # Need to think more about target channel
-            # bot.loop.create_task(self._startup())
-            pass
+            self.resumed = True
+            bot.loop.create_task(self._startup())
+
+    def cog_unload(self):
+        if self.filtered:
+            # The reloaded cog attaches these guilds again on startup; their rules on Twitter sync unchanged
+            for guild_id, stream in list(self.bot.streams.items()):
+                if getattr(stream, 'client', None) is self.filtered:
+                    stream.running = False
+                    del self.bot.streams[guild_id]
+
+            self.filtered.disconnect()
 
     async def check_permission(self, user):
         if not user.guild:
@@ -35,9 +51,36 @@ class Stream(commands.Cog, name='Streams', description="Twitter Search Stream"):
 
     @commands.Cog.listener()
     async def on_ready(self):
-        # Need to think more about target channel
-        # await self._startup()
-        pass
+        # on_ready fires again after reconnects; streams reconnect on their own
+        if not self.resumed:
+            self.resumed = True
+            self.bot.loop.create_task(self._startup())
+
+    @commands.Cog.listener()
+    async def on_config_change(self, guild_id, old, new):
+        """Restarts a server's stream after config.yaml was edited, only if its search or credentials changed"""
+        old_search, new_search = old.get('search', {}), new.get('search', {})
+        stream = self.bot.streams.get(guild_id)
+        if (hasattr(stream, 'sync') and new_search.get('enabled') and old_search.get('channel') == new_search.get('channel')
+                and old.get('credentials') == new.get('credentials')):
+            return await stream.sync()
+
+        if (all(old_search.get(key) == new_search.get(key) for key in ('enabled', 'channel', 'terms'))
+                and old.get('credentials') == new.get('credentials')):
+            return
+
+        if stream := self.bot.streams.pop(guild_id, None):
+            await stream.disconnect()
+
+        if not new_search.get('enabled'):
+            return
+
+        if validation := self.bot.validations.get(guild_id):
+            await validation
+
+        guild = self.bot.get_guild(guild_id)
+        if guild_id in self.bot.twitterApi and guild and (channel := guild.get_channel(new_search.get('channel') or 0)):
+            await self._start_stream(guild_id, channel)
 
     @commands.Cog.listener()
     async def on_command_error(self, ctx: commands.Context, my_error):
@@ -50,44 +93,144 @@ class Stream(commands.Cog, name='Streams', description="Twitter Search Stream"):
             await ctx.send(embed=embed, reference=ctx.message)
 
     async def _startup(self):
+        """Reconnects every enabled stream, staggered so they don't all connect at once"""
+        options = self.bot.settings.get('stream_resume', {})
+        stagger = options.get('stagger', 2.0)
+        jitter = options.get('jitter', 1.0)
+        timeout = options.get('timeout', 60)
+        semaphore = asyncio.Semaphore(options.get('concurrency', 2))
+
+        targets = []
         for guild in self.bot.guilds:
             config = self.bot.config.get(guild.id, {}).get('search', {})
-            if config and config.get('enabled'):
-                await self._start_stream(guild)
+            if config.get('enabled') and guild.id not in self.bot.streams:
+                if channel := guild.get_channel(config.get('channel') or 0):
+                    targets.append((guild, channel))
+
+        if not targets:
+            return
+
+        start = time.perf_counter()
+
+        async def resume(position, guild, channel):
+            await asyncio.sleep(position * stagger + random.uniform(0, jitter))
+            if validation := self.bot.validations.get(guild.id):
+                await validation
+
+            if guild.id not in self.bot.twitterApi:
+                return False
+
+            async with semaphore:
+                if not (stream := await self._start_stream(guild.id, channel)):
+                    return False
+
+                try:
+                    await asyncio.wait_for(stream.connected.wait(), timeout)
+                except asyncio.TimeoutError:
+                    # The listener keeps retrying with backoff; just stop holding a connection slot
+                    return False
+
+            return True
+
+        results = await asyncio.gather(*(resume(i, guild, channel) for i, (guild, channel) in enumerate(targets)),
+                                       return_exceptions=True)
+        elapsed = time.perf_counter() - start
+        telemetry.stream_resume.set(elapsed)
+        print(f'Resumed {sum(1 for r in results if r is True)}/{len(targets)} streams in {elapsed:.1f}s')
+
+    async def _start_stream(self, guild_id, channel):
+        from listener import MyStreamListener
 
-    async def _start_stream(self, ctx):
-        guild_id = ctx.id if isinstance(ctx, discord.Guild) else ctx.guild.id
         terms = self.bot.config.get(guild_id, {}).get('search', {}).get('terms')
         if not terms:
-            return await ctx.channel.send('No terms?')
+            await channel.send('No terms?')
+            return None
 
         api = self.bot.twitterApi[guild_id]  # type: tweepy.API
         tweet_cog = self.bot.get_cog('Twitter')
+        settings = await self.bot.loop.run_in_executor(None, api.get_settings)
+
+        if bearer_token := self.bot.settings.get('filtered_stream', {}).get('bearer_token'):
+            stream = await self._attach_rule(bearer_token, guild_id, settings['screen_name'], channel)
+            if not stream:
+                return None
+        else:
+            stream = self.bot.streams[guild_id] = MyStreamListener(
+                settings['screen_name'],
+                channel,
+                tweet_cog.stream_to_channel,
+                access_token=api.auth.access_token, access_token_secret=api.auth.access_token_secret,
+                consumer_key=api.auth.consumer_key, consumer_secret=api.auth.consumer_secret
+            )
 
-        stream = self.bot.streams[guild_id] = MyStreamListener(
-            api.get_settings()['screen_name'],
-            ctx.channel,
-            tweet_cog.stream_to_channel,
-            access_token=api.auth.access_token, access_token_secret=api.auth.access_token_secret,
-            consumer_key=api.auth.consumer_key, consumer_secret=api.auth.consumer_secret
-        )
+            stream.filter(track=terms)
 
-        await stream.filter(track=terms)
+        if since_id := self.bot.config[guild_id]['search'].get('since_id'):
+            self.bot.loop.create_task(self._backfill(guild_id, channel, settings['screen_name'], terms, since_id))
+
+        return stream
+
+    async def _attach_rule(self, bearer_token, guild_id, account, channel):
+        """Adds the guild's rule to the shared v2 filtered stream, connecting it if this is the first guild"""
+        from filtered import FilteredStream, build_rule
+
+        search = self.bot.config[guild_id]['search']
+        try:
+            build_rule(search['terms'], search.get('ignore', []), account)
+        except ValueError as e:
+            await channel.send(embed=discord.Embed(color=discord.Color.red(), title='Cannot start', description=str(e)))
+            return None
+
+        if self.filtered is None:
+            self.filtered = FilteredStream(bearer_token)
+
+        stream = self.bot.streams[guild_id] = self.filtered.attach(guild_id, account, channel, self.bot.get_cog('Twitter').stream_to_channel,
+                                                                    lambda: self.bot.config[guild_id]['search'])
+        await stream.sync()
+        return stream
+
+    async def _sync_rules(self, guild_id):
+        # Filtered-stream rules follow ignore list changes; a v1.1 stream relies on the local matcher alone
+        if hasattr(stream := self.bot.streams.get(guild_id), 'sync'):
+            await stream.sync()
+
+    async def _backfill(self, guild_id, channel, me, terms, since_id):
+        """Searches for Tweets posted while the stream was down and posts them like streamed ones"""
+        options = self.bot.settings.get('backfill', {})
+        if not options.get('enabled', True):
+            return
+
+        try:
+            statuses = await backfill.search_since(self.bot.loop, self.bot.twitterApi[guild_id], terms, since_id,
+                                                   options.get('slices', 4), options.get('max_pages', 20))
+        except Exception as e:
+            telemetry.errors.inc(where='backfill')
+            print(f'Failed to backfill the stream of {guild_id}.', e)
+            return
+
+        tweet_cog = self.bot.get_cog('Twitter')
+        for status in statuses:
+            if (status := backfill.normalize(status, me)) and (stream := self.bot.streams.get(guild_id)) and stream.running:
+                telemetry.stream_messages.inc(guild=guild_id, stage='backfilled')
+                await tweet_cog.stream_to_channel(channel, status)
 
     async def _to_channel(self, channel, payload):
         if payload['rt'] and self.bot.tweet_candidates.get(payload['rt']):
             return
 
-        post = await channel.send(payload['msg'])
-        for emoji in self.bot.interaction_options:
-            await post.add_reaction(emoji=emoji)
+        post = await self.bot.work.run(channel.guild.id, 'send', channel.send, payload['msg'])
+        await self.bot.get_cog('Twitter').seed_reactions(post, self.bot.interaction_options)
 
     async def _restart_stream(self, ctx):
         guild_id = ctx.guild.id
         stream = self.bot.streams[guild_id]
+        if hasattr(stream, 'sync'):
+            # The new terms only change the guild's rule; the shared connection stays up
+            return await stream.sync()
+
         await stream.disconnect()  # type: MyStreamListener
         del self.bot.streams[ctx.guild.id]
-        await self._start_stream(ctx)
+        await self._start_stream(guild_id, stream.channel)
 
     @commands.group(help="Start or Stop a stream >")
     @commands.guild_only()
@@ -107,10 +250,11 @@ class Stream(commands.Cog, name='Streams', description="Twitter Search Stream"):
             return await ctx.channel.send('Cannot start - No Terms!')
 
         config['enabled'] = True
-        self.bot.save_config()
+        config['channel'] = ctx.channel.id
+        self.bot.save_config(ctx.guild.id)
 
         await ctx.message.add_reaction('🚰')
-        await self._start_stream(ctx)
+        await self._start_stream(ctx.guild.id, ctx.channel)
 
     @stream.command()
     async def stop(self, ctx: commands.Context):
@@ -119,12 +263,47 @@ class Stream(commands.Cog, name='Streams', description="Twitter Search Stream"):
 
         config = self.bot.config.get(ctx.guild.id, {}).get('search', {})
         config['enabled'] = False
-        self.bot.save_config()
+        self.bot.save_config(ctx.guild.id)
 
-        await stream.disconnect()
-        del self.bot.streams[ctx.guild.id]
+        try:
+            await stream.disconnect()
+        finally:
+            self.bot.streams.pop(ctx.guild.id, None)
         await ctx.message.add_reaction('🚱')
 
+    @stream.command(help='Group up to <size> matched Tweets from <window> seconds into one post; 1 turns it off')
+    async def digest(self, ctx: commands.Context, size: int, window: int = 15):
+        size, window = max(1, min(size, len(self.bot.digest_options))), max(1, window)
+        self.bot.config[ctx.guild.id]['search']['digest'] = {'size': size, 'window': window}
+        self.bot.save_config(ctx.guild.id)
+
+        embed = discord.Embed(color=discord.Color.greyple(), title='Digest Updated')
+        embed.description = f"Posting up to {size} Tweets every {window} seconds" if size > 1 else 'Posting every Tweet on its own'
+        await ctx.channel.send(embed=embed)
+
+    @stream.command(help='Only post the <top> most relevant Tweets of every <window> seconds; 0 posts them all')
+    async def top(self, ctx: commands.Context, top: int, window: int = 60):
+        top, window = max(0, top), max(1, window)
+        self.bot.config[ctx.guild.id]['search']['relevance'] = {'top': top, 'window': window}
+        self.bot.save_config(ctx.guild.id)
+
+        embed = discord.Embed(color=discord.Color.greyple(), title='Relevance Updated')
+        embed.description = f"Posting the {top} most relevant Tweets every {window} seconds" if top else 'Posting every matched Tweet'
+        if top and not relevance.available():
+            embed.set_footer(text='NumPy is not installed; every matched Tweet is posted until it is')
+        await ctx.channel.send(embed=embed)
+
+    @stream.command(help='Send stream posts through a webhook, off the rate limits of votes and commands')
+    async def webhook(self, ctx: commands.Context, enabled: bool):
+        self.bot.config[ctx.guild.id]['search']['webhook'] = enabled
+        self.bot.save_config(ctx.guild.id)
+
+        embed = discord.Embed(color=discord.Color.greyple(), title='Stream Delivery Updated')
+        embed.description = 'Posting through a webhook' if enabled else 'Posting as the bot'
+        if enabled and not ctx.channel.permissions_for(ctx.guild.me).manage_webhooks:
+            embed.set_footer(text='I need the Manage Webhooks permission; until then I will keep posting as myself')
+        await ctx.channel.send(embed=embed)
+
     @commands.command(help='Set terms separated by commas')
     @commands.guild_only()
     @can_stream()
@@ -132,7 +311,7 @@ class Stream(commands.Cog, name='Streams', description="Twitter Search Stream"):
         terms = shlex.split(terms)
 
         self.bot.config[ctx.guild.id]['search']['terms'] = terms
-        self.bot.save_config()
+        self.bot.save_config(ctx.guild.id)
 
         embed = discord.Embed(color=discord.Color.greyple(), title='Search Terms Updated',
                               description=f"Searching for `{'` `'.join(terms)}`")
@@ -158,9 +337,11 @@ class Stream(commands.Cog, name='Streams', description="Twitter Search Stream"):
                                   description="No current ignore terms are defined. Add them with `ignore add <term> [<term...>]`")
             return await ctx.channel.send(embed=embed)
 
-        list_output = '\n'.join(f'- `{k}`' for k in ignore_list)
+        hits = self.bot.matcher(ctx.guild.id).hits
+        list_output = '\n'.join(f'- `{k}` ({hits[k]} hits)' for k in ignore_list)
         embed = discord.Embed(color=discord.Color.greyple(), title='Current Ignore List',
                               description=list_output)
+        embed.set_footer(text='Hits are counted since the bot started')
         await ctx.channel.send(embed=embed)
 
     def add_ignore_term(self, guild_id, terms):
@@ -170,13 +351,27 @@ class Stream(commands.Cog, name='Streams', description="Twitter Search Stream"):
         new_list = list(set(self.bot.config[guild_id]['search'].get('ignore', []) + terms))
         new_list.sort()
         self.bot.config[guild_id]['search']['ignore'] = new_list
-        self.bot.save_config()
+        self.bot.save_config(guild_id)
+        self.bot.loop.create_task(self._sync_rules(guild_id))
 
         return new_list
 
     @ignore.command()
     async def add(self, ctx: commands.Context, *, terms):
         terms = shlex.split(terms)
+        try:
+            for term in terms:
+                rules.parse(term)
+
+            # Rules are matched as one pattern, so check them together with the existing ones
+            existing = self.bot.config[ctx.guild.id]['search'].get('ignore', [])
+            if skipped := [term for term in rules.Matcher(existing + terms).skipped if term in terms]:
+                raise ValueError(f'`{skipped[0]}` cannot be combined with the other ignore rules')
+        except ValueError as e:
+            embed = discord.Embed(color=discord.Color.red(), title='Invalid Ignore Rule', description=str(e))
+            embed.add_field(name='Syntax', value='\n'.join(f'`{k}` {v}' for k, v in rules.SYNTAX.items()))
+            return await ctx.channel.send(embed=embed)
+
         new_list = self.add_ignore_term(ctx.guild.id, terms)
 
         list_output = '\n'.join(f'- `{k}`' for k in new_list)
@@ -191,7 +386,8 @@ class Stream(commands.Cog, name='Streams', description="Twitter Search Stream"):
         try:
             ignore_list.remove(term)
             self.bot.config[ctx.guild.id]['search']['ignore'] = ignore_list
-            self.bot.save_config()
+            self.bot.save_config(ctx.guild.id)
+            await self._sync_rules(ctx.guild.id)
             embed = discord.Embed(colour=discord.Colour.blurple(), title='Ignore Term Removed',
                                   description=f"Removed `{term}` from the ignore list")
         except ValueError:
@@ -210,7 +406,8 @@ class Stream(commands.Cog, name='Streams', description="Twitter Search Stream"):
 
         list_output = '\n'.join(f'- `{k}`' for k in ignore_list)
         self.bot.config[ctx.guild.id]['search']['ignore'] = []
-        self.bot.save_config()
+        self.bot.save_config(ctx.guild.id)
+        await self._sync_rules(ctx.guild.id)
         embed = discord.Embed(colour=discord.Colour.lighter_grey(), title='Ignore List Cleared',
                               description=f'The ignore list has been cleared. For reference, this was the previous list:\n{list_output}')
         return await ctx.channel.send(embed=embed)
@@ -223,38 +420,5 @@ class Stream(commands.Cog, name='Streams', description="Twitter Search Stream"):
                         value='`BNB Binance` searches posts for `BNB` _or_ `Binance`\n`BTC "bear market"` searches `BTC` _or_ (`bear` **and** `market`)')
         return await ctx.channel.send(embed=embed)
 
-class MyStreamListener(asynchronous.AsyncStream):
-    def __init__(self, account, channel, callback, **kwargs):
-        super().__init__(**kwargs)
-        self.me = account
-        self.channel = channel
-        self.callback = callback
-        self.running = True
-
-    async def on_data(self, raw_data):
-        if not self.running:
-            return
-
-        data = json.loads(raw_data)
-        if data.get("in_reply_to_status_id") or data.get('retweeted_status'):
-            return
-
-        await super().on_data(raw_data)
-
-    async def on_status(self, status):
-        if self.running and status.author.screen_name != self.me:
-            if not hasattr(status, 'quoted_status'):
-                status.quoted_status = None
-                status.quoted_status_id = None
-
-            if status.quoted_status and not hasattr(status.quoted_status, 'extended_tweet'):
-                status.quoted_status.extended_tweet = {}
-
-            await self.callback(self.channel, status)
-
-    async def disconnect(self):
-        self.running = False
-        super().disconnect()
-
 def setup(bot):
     bot.add_cog(Stream(bot))
@@ -1,17 +1,20 @@
+import html
 import io
 import os
 import re
 import shlex
 import time
 import urllib.request
+from collections import deque
 from urllib.parse import urlparse
 
 import discord
-import emoji
-import requests
 from discord.ext import commands, tasks
-import tweepy
 from mooBird import MooBird
+import media
+import relevance
+import telemetry
+from tracing import tracer
 
 def can_tweet():
     def predicate(ctx):
@@ -22,13 +25,32 @@ def can_tweet():
 class Twitter(commands.Cog, name='Twitter', description="Twitter Interaction"):
     interaction_string = "`💬 {} 🔃 {} ❤️ {}`"
     no_speak = '🙊'
+    seen_size = 5000
+    checkpoint_interval = 30
 
     def __init__(self, bot):
         self.bot = bot  # type: MooBird
+        self.digests = {}
+        self.seen = {}
+        self.checkpointed = {}
+        self.held = {}
+        self.handled = {}
+        self.relevance = relevance.RelevanceStage(bot.loop, self._publish,
+                                                  lambda channel, item: self._settle(channel.guild.id, item['tweet_id']))
         self.cleanup.start()
 
+        if self.bot.is_ready():
+            bot.loop.create_task(self._resume_journal())
+
     def cog_unload(self):
         self.cleanup.cancel()
+        self.relevance.stop()
+        for digest in self.digests.values():
+            digest['timer'].cancel()
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        self.bot.loop.create_task(self._resume_journal())
 
     @commands.Cog.listener()
     async def on_command_error(self, ctx, error):
@@ -40,6 +62,8 @@ class Twitter(commands.Cog, name='Twitter', description="Twitter Interaction"):
 
     @staticmethod
     async def validate_credentials(credentials: dict):
+        import tweepy
+
         auth = tweepy.OAuthHandler(credentials['API Key'], credentials['API Secret'])
         auth.set_access_token(credentials['Access Token'], credentials['Access Secret'])
         api = tweepy.API(auth)
@@ -82,79 +106,256 @@ class Twitter(commands.Cog, name='Twitter', description="Twitter Interaction"):
 
         # Interactions
         to_delete = {vote_id: info for (vote_id, info) in self.bot.tweet_candidates.items() if
-                     info['action'] == 'interact' and (now - info['proposed']) > interaction_threshold}
+                     info['action'] in ('interact', 'digest') and (now - info['proposed']) > interaction_threshold
+                     and not self._executing(info)}
 
         for vote_id, info in to_delete.items():
-            for cur_emoji in self.bot.interaction_options:
+            # Digest items share their digest's message, which is cleared once for all of them
+            for cur_emoji in self.bot.interaction_options if 'digest' not in info else ():
                 try:
                     await info['message'].clear_reaction(cur_emoji)
                 except Exception:
                     pass
 
-            del self.bot.tweet_candidates[vote_id]
+            if info['action'] == 'interact':
+                self.bot.analytics.record(info['message'].channel.guild.id, 'expired')
+            self.bot.tweet_candidates.pop(vote_id, None)
 
         to_delete = {vote_id: info for (vote_id, info) in self.bot.tweet_candidates.items() if
-                     info['action'] == 'tweet' and (now - info['proposed']) > tweet_threshold}
+                     info['action'] == 'tweet' and (now - info['proposed']) > tweet_threshold and not self._executing(info)}
 
         for vote_id, info in to_delete.items():
+            self._discard_media(info)
+            self.bot.analytics.record(info['message'].guild.id, 'timed_out')
             if vote := await info['message'].channel.fetch_message(vote_id):
                 embed = discord.Embed(color=discord.Colour.greyple(), title='Vote Timed Out',
                                       description="This vote failed to pass, but can restarted at any time.")
                 await vote.delete()
                 await info['message'].channel.send(embed=embed, reference=info['message'])
 
-            del self.bot.tweet_candidates[vote_id]
+            self.bot.tweet_candidates.pop(vote_id, None)
 
     async def stream_to_channel(self, channel, status):
-        if status.quoted_status:
-            terms = self.bot.config[channel.guild.id]['search']['terms']
-            if any(word in status.quoted_status.extended_tweet.get('full_text', status.quoted_status.text) for word in terms):
+        with tracer.span('stream_to_channel', trace_id=tracer.current() or tracer.new_trace(), tweet_id=status.id) as span:
+            if not self._first_sighting(channel.guild.id, status.id):
+                telemetry.stream_messages.inc(guild=channel.guild.id, stage='duplicate')
                 return
 
-        ignore_list = self.bot.config[channel.guild.id]['search'].get('ignore', [])
+            self._hold(channel.guild.id, status.id)
+            if self._filter_status(channel.guild.id, status):
+                telemetry.stream_messages.inc(guild=channel.guild.id, stage='filtered')
+                return self._settle(channel.guild.id, status.id)
 
-        user_ignore = [user.lower()[1:] for user in ignore_list if user.startswith('@')]
-        if status.author.screen_name.lower() in user_ignore:
-            return
+            text = self._text_of(status)
+            item = {
+                'tweet_id'    : status.id,
+                'tweet_author': status.author.screen_name.lower(),
+                'link'        : f"https://twitter.com/{status.author.screen_name}/status/{status.id}",
+                'text'        : text,
+                'term'        : self._term_of(channel.guild.id, text),
+                'trace'       : span['trace_id']
+            }
+
+            top, window = self._relevance_options(channel.guild.id)
+            if top and relevance.available():
+                return self.relevance.submit(channel.guild.id, channel, item, top, window)
+
+            await self._publish(channel, item)
+
+    async def _publish(self, channel, item):
+        self.bot.analytics.record(channel.guild.id, 'streamed', item['term'])
+        if self._digest_options(channel.guild.id)[0] > 1:
+            return self._queue_digest(channel, item)
+
+        try:
+            post = await self._deliver(channel, item['link'])
+        finally:
+            self._settle(channel.guild.id, item['tweet_id'])
+        telemetry.stream_messages.inc(guild=channel.guild.id, stage='posted')
+
+        with tracer.span('tweet_candidates', trace_id=item['trace'], message_id=post.id):
+            self.bot.tweet_candidates[post.id] = {
+                'votes'   : {},
+                'proposed': int(time.time()),
+                'action'  : 'interact',
+                'message' : post,
+                **item
+            }
+            tracer.link(post.id, item['trace'])
+
+        await self.seed_reactions(post, self.bot.interaction_options)
+
+    def _relevance_options(self, guild_id):
+        options = self.bot.config[guild_id]['search'].get('relevance') or {}
+        return options.get('top', 0), options.get('window', 60)
+
+    def _first_sighting(self, guild_id, tweet_id):
+        # Backfilled and live Tweets overlap around a reconnect; each is handled once
+        order, ids = self.seen.setdefault(guild_id, (deque(), set()))
+        if tweet_id in ids:
+            return False
+
+        order.append(tweet_id)
+        ids.add(tweet_id)
+        if len(order) > self.seen_size:
+            ids.discard(order.popleft())
+
+        return True
 
-        tweet_text = status.text if not status.truncated else status.extended_tweet['full_text']
-        if any(word.lower() in tweet_text.lower() for word in ignore_list):
+    def _hold(self, guild_id, tweet_id):
+        # Until it is posted or dropped, a Tweet may still be waiting in a digest or relevance window
+        self.held.setdefault(guild_id, set()).add(tweet_id)
+
+    def _settle(self, guild_id, tweet_id):
+        """Marks a Tweet as posted or dropped, and checkpoints up to just below the oldest one still held"""
+        held = self.held.setdefault(guild_id, set())
+        held.discard(tweet_id)
+        self.handled[guild_id] = handled = max(self.handled.get(guild_id, 0), tweet_id)
+        self._checkpoint(guild_id, min(handled, min(held) - 1) if held else handled)
+
+    def _checkpoint(self, guild_id, tweet_id):
+        """Remembers the newest Tweet handled so a later reconnect can backfill from it"""
+        search = self.bot.config[guild_id]['search']
+        if tweet_id <= (search.get('since_id') or 0):
             return
 
-        if tweet_text.count('$') > 15:
+        search['since_id'] = tweet_id
+        now = time.time()
+        if now - self.checkpointed.get(guild_id, 0) > self.checkpoint_interval:
+            self.checkpointed[guild_id] = now
+            self.bot.save_config(guild_id)
+
+    def _digest_options(self, guild_id):
+        digest = self.bot.config[guild_id]['search'].get('digest') or {}
+        return min(digest.get('size', 1), len(self.bot.digest_options)), digest.get('window', 15)
+
+    def _queue_digest(self, channel, item):
+        """Holds a matched Tweet until its guild's digest is full or its window has passed"""
+        guild_id = channel.guild.id
+        size, window = self._digest_options(guild_id)
+        if not (digest := self.digests.get(guild_id)):
+            digest = self.digests[guild_id] = {
+                'channel': channel,
+                'items'  : [],
+                'timer'  : self.bot.loop.call_later(window, self._flush_digest, guild_id)
+            }
+
+        digest['items'].append(item)
+
+        if len(digest['items']) >= size:
+            self._flush_digest(guild_id)
+
+    def _flush_digest(self, guild_id):
+        if not (digest := self.digests.pop(guild_id, None)):
             return
 
-        msg = f"https://twitter.com/{status.author.screen_name}/status/{status.id}"
-        post = await channel.send(msg)
+        digest['timer'].cancel()
+        self.bot.loop.create_task(self._send_digest(digest['channel'], digest['items']))
+
+    async def _send_digest(self, channel, items):
+        """Posts several matched Tweets as one message; each Tweet keeps its own candidate, keyed (message id, index)"""
+        guild_id = channel.guild.id
+        numbers = self.bot.digest_options[:len(items)]
+        msg = '\n'.join(f"{number} {item['link']}" for number, item in zip(numbers, items))
+        msg += f"\nPick Tweets by number, then react with {' '.join(self.bot.interaction_options)}"
 
+        try:
+            post = await self._deliver(channel, msg)
+        finally:
+            for item in items:
+                self._settle(guild_id, item['tweet_id'])
+        telemetry.stream_messages.inc(len(items), guild=guild_id, stage='posted')
+
+        now = int(time.time())
         self.bot.tweet_candidates[post.id] = {
-            'votes'       : {},
-            'proposed'    : int(time.time()),
-            'action'      : 'interact',
-            'tweet_id'    : status.id,
-            'tweet_author': status.author.screen_name.lower(),
-            'message'     : post
+            'votes'   : {},
+            'proposed': now,
+            'action'  : 'digest',
+            'message' : post,
+            'size'    : len(items),
+            'selected': {}
         }
 
-        for cur_emoji in self.bot.interaction_options:
-            await post.add_reaction(emoji=cur_emoji)
+        for index, item in enumerate(items):
+            with tracer.span('tweet_candidates', trace_id=item['trace'], message_id=post.id, index=index):
+                self.bot.tweet_candidates[(post.id, index)] = {
+                    'votes'   : {},
+                    'voters'  : {},
+                    'proposed': now,
+                    'action'  : 'interact',
+                    'message' : post,
+                    'digest'  : post.id,
+                    **item
+                }
+
+        await self.seed_reactions(post, numbers + self.bot.interaction_options)
+
+    async def _deliver(self, channel, msg):
+        """Sends a stream post through the channel's webhook when the guild has turned that on"""
+        if self.bot.config[channel.guild.id]['search'].get('webhook'):
+            try:
+                return await self.bot.relay.send(channel, msg)
+            except discord.HTTPException as e:
+                # Most likely missing Manage Webhooks; the post still goes out as the bot
+                telemetry.errors.inc(where='webhook')
+                print(f'Webhook delivery failed in {channel.id}.', e)
+
+        return await self.bot.work.run(channel.guild.id, 'send', channel.send, msg)
+
+    async def seed_reactions(self, message: discord.Message, options):
+        """Adds the voting reactions in the guild's turn, weighted by the number of reactions"""
+        async def add_reactions():
+            for cur_emoji in options:
+                await message.add_reaction(emoji=cur_emoji)
+
+        await self.bot.work.run(message.channel.guild.id, 'react', add_reactions, cost=len(options))
+
+    def _filter_status(self, guild_id, status):
+        quoted_text = ''
+        if status.quoted_status:
+            quoted_text = status.quoted_status.extended_tweet.get('full_text', status.quoted_status.text)
+            terms = self.bot.config[guild_id]['search']['terms']
+            if any(word in quoted_text for word in terms):
+                return True
+
+        return self.bot.matcher(guild_id).match(status.author.screen_name, self._text_of(status), quoted_text) is not None
+
+    def _term_of(self, guild_id, text):
+        # The search term that brought a Tweet in, so mutes can be traced back to it
+        text = text.lower()
+        return next((term for term in self.bot.config[guild_id]['search']['terms'] if term.lower() in text), '')
+
+    @staticmethod
+    def _text_of(status):
+        return status.text if not status.truncated else status.extended_tweet['full_text']
 
     async def _post(self, message_id):
         if not (message_info := self.bot.tweet_candidates.get(message_id)):
             return None
 
+        with tracer.span('_post', trace_id=message_info.get('trace')):
+            return await self._send_tweet(message_id, message_info)
+
+    async def _send_tweet(self, message_id, message_info, resume=None):
         message = message_info['message']  # type: discord.Message
 
         api = self.bot.twitterApi[message.guild.id]
+        scheduler = self.bot.scheduler(message.guild.id)
+        await self._announce_eta(message.channel, scheduler, 'statuses/update', scheduler.VOTE)
 
         message_content = message.clean_content
-        attachments = message.attachments
+        account = telemetry.account_of(api)
+        since = resume['payload']['since'] if resume else time.time()
+        prepared = await (message_info.get('media') or self.bot.media.prepare_all(message.attachments, account))
         media_ids = []
-        for i in range(0, len(attachments)):
-            filename = attachments[i].filename
-            content_type = attachments[i].content_type
+        for attachment, (data, content_type, filename, digest) in zip(message.attachments, prepared):
+            if media_id := self.bot.media.uploads.get(account, digest):
+                media_ids.append(media_id)
+                continue
 
-            data = io.BytesIO(await attachments[i].read())
+            if data is None:
+                # Cached when the vote started, expired since
+                data, content_type, filename, digest = await self.bot.media.prepare(attachment)
 
             media_category = 'tweet_image'
             if 'video' in content_type:
@@ -162,41 +363,74 @@ class Twitter(commands.Cog, name='Twitter', description="Twitter Interaction"):
             if 'gif' in content_type:
                 media_category = 'tweet_gif'
 
-            res = api.media_upload(filename=filename, file=data, chunked=True, media_category=media_category)
+            res = await scheduler.call('media/upload', api.media_upload, filename=filename, file=io.BytesIO(data), chunked=True,
+                                       media_category=media_category, priority=scheduler.VOTE, guild_id=message.guild.id)
             media_ids.append(res.media_id)
+            self.bot.media.uploads.put(account, digest, res.media_id, getattr(res, 'expires_after_secs', None) or 86400)
 
-        status = api.update_status(status=message_content, media_ids=media_ids)  # type: tweepy.Status
+        status = await self._journaled('tweet', message.guild.id, message.channel.id, message.id,
+                                       {'text': message_content, 'media_ids': media_ids, 'since': since},
+                                       resume and resume['id'])  # type: tweepy.Status
+        message_info['status'] = status
 
-        del self.bot.tweet_candidates[message_id]
+        self.bot.tweet_candidates.pop(message_id, None)
 
         return f'https://twitter.com/{status.author.screen_name}/status/{status.id_str}'
 
+    def _prepare_media(self, message: discord.Message):
+        """Starts downloading (and if needed, shrinking) attachments so they are ready when the vote passes"""
+        if not message.attachments:
+            return None
+
+        account = telemetry.account_of(self.bot.twitterApi[message.guild.id])
+        task = self.bot.loop.create_task(self.bot.media.prepare_all(message.attachments, account))
+        # A failed vote never awaits the task; retrieve its exception so it isn't reported as unhandled
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return task
+
+    @staticmethod
+    def _discard_media(candidate):
+        if (task := candidate.get('media')) and not task.done():
+            task.cancel()
+
     async def _action(self, ctx: discord.Message, candidate, voters, action):
-        api = self.bot.twitterApi[ctx.guild.id]
+        with tracer.span('_action', trace_id=candidate.get('trace'), action=action):
+            await self._perform_action(ctx, candidate, voters, action)
+
+    async def _perform_action(self, ctx: discord.Message, candidate, voters, action):
+        scheduler = self.bot.scheduler(ctx.guild.id)
 
         if 'retweet' in action:
-            api.retweet(candidate['tweet_id'])
+            await self._announce_eta(ctx.channel, scheduler, 'statuses/retweet/:id', scheduler.RETWEET, ctx)
+            await self._journaled('retweet', ctx.guild.id, ctx.channel.id, ctx.id, {'tweet_id': candidate['tweet_id']})
             icon = '🔃'
             color = discord.Color.blurple()
             title = f"{icon} Retweeted"
 
         if 'favorite' in action:
-            api.create_favorite(candidate['tweet_id'])
+            await self._announce_eta(ctx.channel, scheduler, 'favorites/create', scheduler.LIKE, ctx)
+            await self._journaled('favorite', ctx.guild.id, ctx.channel.id, ctx.id, {'tweet_id': candidate['tweet_id']})
+            self.relevance.learn(ctx.guild.id, candidate.get('text'), candidate['tweet_author'], liked=True)
             icon = '♥️'
             color = discord.Color.magenta()
             title = f"{icon} Liked"
 
         if 'mute' in action:
+            self.bot.ensure_extension('commands.stream')
             stream = self.bot.get_cog('Streams')
             stream.add_ignore_term(ctx.guild.id, '@' + candidate['tweet_author'])
+            self.relevance.learn(ctx.guild.id, candidate.get('text'), candidate['tweet_author'], liked=False)
             icon = '🤐'
             color = discord.Color.greyple()
             title = f"{icon} @{candidate['tweet_author']} Muted"
+            self.bot.analytics.record(ctx.guild.id, 'mute_term', candidate.get('term', ''))
 
         if 'cowmoonity' in action:
-            await ctx.clear_reactions()
+            if 'digest' not in candidate:
+                await ctx.clear_reactions()
             try:
-                self.submit_to_trello(ctx)
+                await self._journaled('trello', ctx.guild.id, ctx.channel.id, ctx.id,
+                                      {'name': candidate.get('link') or ctx.content})
             except Exception as e:
                 embed = discord.Embed(color=discord.Color.red(), title='Error')
                 embed.description = 'An error occurred while sending this to the Cowmoonity'
@@ -207,10 +441,22 @@ class Twitter(commands.Cog, name='Twitter', description="Twitter Interaction"):
             color = discord.Color.gold()
             title = f"{icon} Submitted to Cowmmoonity"
 
-        await ctx.add_reaction(icon)
         embed = discord.Embed(color=color, title=title)
+        if 'digest' in candidate:
+            embed.add_field(name='Tweet', value=candidate['link'], inline=False)
+        else:
+            await ctx.add_reaction(icon)
         embed.add_field(name='Voters', value=voters)
         await ctx.channel.send(embed=embed, reference=ctx)
+        self.bot.analytics.record(ctx.guild.id, 'interaction', action)
+
+    async def _announce_eta(self, channel, scheduler, endpoint, priority, reference=None):
+        if (eta := scheduler.eta(endpoint, priority)) < 5:
+            return
+
+        embed = discord.Embed(color=discord.Color.orange(), title='⏳ Queued',
+                              description=f"Twitter's rate limit has been reached. This will be sent <t:{int(time.time() + eta)}:R>.")
+        await channel.send(embed=embed, reference=reference)
 
     async def _check_vote_threshold(self, guild, votes):
         needed_votes = self.bot.config[guild.id]['votes_needed']
@@ -222,24 +468,129 @@ class Twitter(commands.Cog, name='Twitter', description="Twitter Interaction"):
 
         return None
 
-    def submit_to_trello(self, ctx: discord.Message):
-        url = "https://api.trello.com/1/cards"
-
-        query = self.bot.config[ctx.guild.id].get('trello', {})
-        if not query:
+    def _trello_query(self, guild_id):
+        if not (query := self.bot.config[guild_id].get('trello', {})):
             raise Exception('No Trello configuration!')
 
+        return dict(query)
+
+    def submit_to_trello(self, guild_id, name):
+        import requests
+
+        query = self._trello_query(guild_id)
         query['cardRole'] = 'link'
-        query['name'] = ctx.content
+        query['name'] = name
+
+        response = requests.request("POST", "https://api.trello.com/1/cards", params=query, timeout=30)
+        response.raise_for_status()
+        return response.json()
+
+    def find_trello_card(self, guild_id, name):
+        """The card an earlier submission of `name` created, if it got through"""
+        import requests
+
+        query = self._trello_query(guild_id)
+        response = requests.get(f"https://api.trello.com/1/lists/{query['idList']}/cards", timeout=30,
+                                params={'key': query.get('key'), 'token': query.get('token'), 'fields': 'name'})
+        response.raise_for_status()
+        return next((card for card in response.json() if card['name'] == name), None)
+
+    async def _journaled(self, kind, guild_id, channel_id, message_id, payload, action_id=None):
+        """Runs a passed action through the journal, which retries it without repeating it"""
+        api = self.bot.twitterApi[guild_id]
+        scheduler = self.bot.scheduler(guild_id)
+        loop = self.bot.loop
+
+        if kind == 'tweet':
+            def perform():
+                return scheduler.call('statuses/update', api.update_status, status=payload['text'],
+                                      media_ids=payload['media_ids'], priority=scheduler.VOTE, guild_id=guild_id)
+
+            def verify():
+                return loop.run_in_executor(None, self._find_posted, api, payload['text'], payload['since'])
+        elif kind == 'retweet':
+            def perform():
+                return scheduler.call('statuses/retweet/:id', api.retweet, payload['tweet_id'],
+                                      priority=scheduler.RETWEET, guild_id=guild_id)
+
+            def verify():
+                return loop.run_in_executor(None, self._find_status, api, payload['tweet_id'], 'retweeted')
+        elif kind == 'favorite':
+            def perform():
+                return scheduler.call('favorites/create', api.create_favorite, payload['tweet_id'],
+                                      priority=scheduler.LIKE, guild_id=guild_id)
+
+            def verify():
+                return loop.run_in_executor(None, self._find_status, api, payload['tweet_id'], 'favorited')
+        elif kind == 'trello':
+            def perform():
+                return loop.run_in_executor(None, self.submit_to_trello, guild_id, payload['name'])
+
+            def verify():
+                return loop.run_in_executor(None, self.find_trello_card, guild_id, payload['name'])
+        else:
+            raise ValueError(f'Unknown action {kind}')
+
+        return await self.bot.journal.run(kind, perform, verify, action_id, guild_id=guild_id, channel_id=channel_id,
+                                          message_id=message_id, payload=payload)
+
+    @staticmethod
+    def _plain(text):
+        # Twitter shortens links and escapes HTML in what it stores
+        return re.sub(r'https?://\S+', '', html.unescape(text)).strip()
+
+    @classmethod
+    def _find_posted(cls, api, text, since):
+        """Our Tweet of `text` posted after `since`, if an earlier attempt went through"""
+        for status in api.user_timeline(count=20, tweet_mode='extended', include_rts=False):
+            if status.created_at.timestamp() < since - 60:
+                break
+            if cls._plain(status.full_text) == cls._plain(text):
+                return status
 
-        response = requests.request(
-            "POST",
-            url,
-            params=query
-        )
+        return None
+
+    @staticmethod
+    def _find_status(api, tweet_id, flag):
+        status = api.get_status(tweet_id)
+        return status if getattr(status, flag) else None
+
+    async def _resume_journal(self):
+        """Finishes actions that passed their vote before a restart but never completed"""
+        if self.bot.journal_resumed:
+            return
 
-        if not response.status_code:
-            raise Exception(f'Error: `{response.text}`')
+        self.bot.journal_resumed = True
+        for entry in await self.bot.journal.pending():
+            guild_id = entry['guild_id']
+            if validation := self.bot.validations.get(guild_id):
+                await validation
+            if guild_id not in self.bot.twitterApi or not (channel := self.bot.get_channel(entry['channel_id'])):
+                continue
+
+            try:
+                if entry['kind'] == 'tweet':
+                    # Look for the Tweet before downloading and uploading its media again
+                    payload = entry['payload']
+                    if status := await self.bot.loop.run_in_executor(None, self._find_posted, self.bot.twitterApi[guild_id],
+                                                                     payload['text'], payload['since']):
+                        await self.bot.journal.write(entry['id'], 'done', result=status.id, recovered=True)
+                        description = f'https://twitter.com/{status.author.screen_name}/status/{status.id_str}'
+                    else:
+                        message = await channel.fetch_message(entry['message_id'])
+                        description = await self._send_tweet(None, {'message': message}, resume=entry)
+                else:
+                    await self._journaled(entry['kind'], guild_id, entry['channel_id'], entry['message_id'],
+                                          entry['payload'], entry['id'])
+                    description = entry['payload'].get('name') or f"Tweet {entry['payload']['tweet_id']}"
+            except Exception as e:
+                telemetry.errors.inc(where='journal_resume')
+                print(f"Failed to resume a {entry['kind']} in {guild_id}.", e)
+                continue
+
+            embed = discord.Embed(color=discord.Color.green(), title='♻️ Completed after restart',
+                                  description=f"{entry['kind'].capitalize()}: {description}")
+            await channel.send(embed=embed)
 
     @commands.command(help='Mark a message for a Tweet vote')
     @can_tweet()
@@ -278,43 +629,49 @@ class Twitter(commands.Cog, name='Twitter', description="Twitter Interaction"):
                     embed.description = embed.description.replace(cur_embed.url, '')
                     embed.set_image(url=cur_embed.url)
 
+        import emoji
         message_length += emoji.emoji_count(message_content)
 
         if message_length > 280:
             return await ctx.channel.send(f'This message is too large by {message_length - 280} characters!')
 
         if len(message_ref.attachments):
-            max_size = 5
+            attachment = message_ref.attachments[0]
+            kind = media.kind_of(attachment.content_type)
 
-            if 'video' in message_ref.attachments[0].content_type:
-                max_size = 15
+            if kind == 'video':
                 embed.add_field(name='Attachment', value='Video')
-            else:
-                if 'gif' in message_ref.attachments[0].content_type:
-                    max_size = 15
+            elif not embed.image:
+                embed.set_image(url=attachment.url)
 
-                if not embed.image:
-                    embed.set_image(url=message_ref.attachments[0].url)
+            if any(a.size > media.LIMITS[media.kind_of(a.content_type)] for a in message_ref.attachments):
+                if not all(media.can_shrink(a.content_type) for a in message_ref.attachments):
+                    max_size = media.LIMITS[kind] // media.MB
+                    embed = discord.Embed(color=discord.Color.red(), title="Attachment too large", description=f"The attached media exceeds the {max_size} MB maximum!")
+                    embed.add_field(name='Guide', value="Images: 5 MB\nGIF/Video: 15 MB")
+                    return await ctx.channel.send(embed=embed, reference=message_ref, mention_author=True)
 
-            if message_ref.attachments[0].size / 1024000 > max_size:
-                embed = discord.Embed(color=discord.Color.red(), title="Attachment too large", description=f"The attached media exceeds the {max_size} MB maximum!")
-                embed.add_field(name='Guide', value="Images: 5 MB\nGIF/Video: 15 MB")
-                return await ctx.channel.send(embed=embed, reference=message_ref, mention_author=True)
+                embed.add_field(name='Resizing', value="The attached media is over Twitter's limit and is being resized while you vote.", inline=False)
 
         embed.set_footer(text=f"Posting to @{self.bot.twitterApi[ctx.guild.id].get_settings()['screen_name']} - Vote Below!")
 
         voting = await ctx.channel.send(embed=embed, reference=message_ref, mention_author=False)
 
-        self.bot.tweet_candidates[voting.id] = {
-            'votes'   : {},
-            'proposed': int(time.time()),
-            'action'  : 'tweet',
-            'tweet_id': None,
-            'message' : message_ref
-        }
-
-        for cur_emoji in self.bot.response_options:
-            await voting.add_reaction(emoji=cur_emoji)
+        trace_id = tracer.new_trace()
+        with tracer.span('tweet_candidates', trace_id=trace_id, message_id=voting.id):
+            self.bot.tweet_candidates[voting.id] = {
+                'votes'   : {},
+                'proposed': int(time.time()),
+                'action'  : 'tweet',
+                'tweet_id': None,
+                'message' : message_ref,
+                'trace'   : trace_id,
+                'media'   : self._prepare_media(message_ref)
+            }
+            tracer.link(voting.id, trace_id)
+
+        self.bot.analytics.record(ctx.guild.id, 'proposed')
+        await self.seed_reactions(voting, self.bot.response_options)
 
     @commands.command(help="Mark a message for retweet")
     @can_tweet()
@@ -370,19 +727,27 @@ class Twitter(commands.Cog, name='Twitter', description="Twitter Interaction"):
                 to_delete.append(vote_msg)
 
         for vote_msg in to_delete:
-            del self.bot.tweet_candidates[vote_msg]
+            self._discard_media(self.bot.tweet_candidates.pop(vote_msg))
 
     @commands.Cog.listener()
     async def on_reaction_add(self, reaction, user):
-        if user.bot or reaction.message.author.id != self.bot.user.id:
+        if user.bot or (reaction.message.author.id != self.bot.user.id and not self.bot.relay.owns(reaction.message)):
             return
 
         if not (candidate := self.bot.tweet_candidates.get(reaction.message.id)):
             return
 
+        with tracer.span('on_reaction_add', trace_id=candidate.get('trace'), emoji=str(reaction.emoji)):
+            await self._handle_reaction(reaction, user, candidate)
+
+    async def _handle_reaction(self, reaction, user, candidate):
         if not await self.check_permission(user):
             return await reaction.message.remove_reaction(reaction, user)
 
+        self.bot.analytics.record(reaction.message.guild.id, 'vote', user.id)
+        if candidate['action'] == 'digest':
+            return await self._handle_digest_reaction(reaction, user, candidate)
+
         if candidate['action'] == 'interact':
             if reaction.emoji not in self.bot.interaction_options:
                 return
@@ -392,15 +757,19 @@ class Twitter(commands.Cog, name='Twitter', description="Twitter Interaction"):
 
             candidate['votes'][reaction.emoji] = reaction.count - 1
             needed_votes = self.bot.config[reaction.message.guild.id]['votes_needed']
-            if candidate['votes'][reaction.emoji] >= needed_votes:
-                updated_message = await msg.channel.fetch_message(msg.id)
-                voters = ' '.join([user.mention for user in await updated_message.reactions[idx].users().flatten() if not user.bot])
+            actions = ['favorite', 'mute', 'cowmoonity']
+            if candidate['votes'][reaction.emoji] >= needed_votes and idx < len(actions):
+                if not self._claim(candidate, actions[idx]):
+                    return
 
-                await reaction.message.clear_reaction(reaction)
+                try:
+                    updated_message = await msg.channel.fetch_message(msg.id)
+                    voters = ' '.join([user.mention for user in await updated_message.reactions[idx].users().flatten() if not user.bot])
 
-                actions = ['favorite', 'mute', 'cowmoonity']
-                if idx < len(actions):
+                    await reaction.message.clear_reaction(reaction)
                     await self._action(reaction.message, candidate, voters, actions[idx])
+                finally:
+                    candidate['flights'][actions[idx]] = 'done'
 
         if candidate['action'] == 'tweet':
             candidate['votes'][reaction.emoji] = reaction.count - 1
@@ -408,26 +777,99 @@ class Twitter(commands.Cog, name='Twitter', description="Twitter Interaction"):
             message = reaction.message
             action = await self._check_vote_threshold(reaction.message.guild, candidate['votes'])
 
-            if action == 'pass':
-                async with message.channel.typing():
-                    try:
-                        updated_message = await message.channel.fetch_message(message.id)
-                        voters = ' '.join([user.mention for user in await updated_message.reactions[0].users().flatten() if not user.bot])
+            # Reactions arriving while the vote is being carried out only update the count
+            if action not in ('pass', 'fail') or not self._claim(candidate, 'vote'):
+                return
+
+            try:
+                if action == 'pass':
+                    return await self._pass_vote(message, candidate)
 
-                        await message.delete()
-                        post_link = await self._post(message.id)
-                        # await message.channel.send(self.interaction_string.format(0, 0, 0) + '\n' + post_link)
+                await self._fail_vote(message, candidate)
+            finally:
+                candidate['flights']['vote'] = 'done'
 
-                        return await message.channel.send(f"Voters: {voters}\n" + post_link, allowed_mentions=discord.AllowedMentions(users=False))
-                    except Exception as e:
-                        print(e)
-                        await message.channel.send('An error occurred sending this Tweet!')
+    @staticmethod
+    def _claim(candidate, key):
+        """Moves `key` of a candidate from open to executing; False if a concurrent reaction already has"""
+        flights = candidate.setdefault('flights', {})
+        if flights.get(key, 'open') != 'open':
+            return False
+
+        flights[key] = 'executing'
+        return True
+
+    @staticmethod
+    def _executing(candidate):
+        return 'executing' in candidate.get('flights', {}).values()
+
+    async def _pass_vote(self, message, candidate):
+        async with message.channel.typing():
+            try:
+                updated_message = await message.channel.fetch_message(message.id)
+                voters = ' '.join([user.mention for user in await updated_message.reactions[0].users().flatten() if not user.bot])
 
-            if action == 'fail':
                 await message.delete()
-                embed = discord.Embed(color=discord.Color.dark_red(), title='Voted Down',
-                                      description='This proposal was voted down and has not been sent.')
-                await message.channel.send(embed=embed)
+                post_link = await self._post(message.id)
+
+                result = await message.channel.send(f"Voters: {voters}\n" + post_link, allowed_mentions=discord.AllowedMentions(users=False))
+                if tracker := self.bot.get_cog('Engagement'):
+                    tracker.track(message.guild.id, candidate['status'], result)
+
+                self.bot.analytics.record(message.guild.id, 'passed', value=time.time() - candidate['proposed'])
+                return result
+            except Exception as e:
+                telemetry.errors.inc(where='post')
+                print(e)
+                await message.channel.send('An error occurred sending this Tweet!')
+
+    async def _fail_vote(self, message, candidate):
+        self._discard_media(candidate)
+        self.bot.analytics.record(message.guild.id, 'failed')
+        self.bot.tweet_candidates.pop(message.id, None)
+        await message.delete()
+        embed = discord.Embed(color=discord.Color.dark_red(), title='Voted Down',
+                              description='This proposal was voted down and has not been sent.')
+        await message.channel.send(embed=embed)
+
+    async def _handle_digest_reaction(self, reaction, user, digest):
+        message = reaction.message
+        if reaction.emoji in self.bot.digest_options[:digest['size']]:
+            digest['selected'].setdefault(user.id, set()).add(self.bot.digest_options.index(reaction.emoji))
+            return
+
+        if reaction.emoji not in self.bot.interaction_options:
+            return
+
+        # An interaction applies to the Tweets this user has picked by number
+        if not (selected := digest['selected'].get(user.id)):
+            return await message.remove_reaction(reaction, user)
+
+        idx = self.bot.interaction_options.index(reaction.emoji)
+        needed_votes = self.bot.config[message.guild.id]['votes_needed']
+        for index in sorted(selected):
+            if not (item := self.bot.tweet_candidates.get((message.id, index))):
+                continue
+
+            voters = item['voters'].setdefault(reaction.emoji, set())
+            voters.add(user)
+            item['votes'][reaction.emoji] = len(voters)
+            if len(voters) >= needed_votes:
+                self.bot.tweet_candidates.pop((message.id, index))
+                with tracer.span('on_reaction_add', trace_id=item.get('trace'), emoji=str(reaction.emoji)):
+                    await self._action(message, item, ' '.join(voter.mention for voter in voters),
+                                       ['favorite', 'mute', 'cowmoonity'][idx])
+
+    def _handle_digest_removal(self, reaction, user, digest):
+        selected = digest['selected'].get(user.id, set())
+        if reaction.emoji in self.bot.digest_options:
+            selected.discard(self.bot.digest_options.index(reaction.emoji))
+            return
+
+        for index in selected:
+            if item := self.bot.tweet_candidates.get((reaction.message.id, index)):
+                item['voters'].get(reaction.emoji, set()).discard(user)
+                item['votes'][reaction.emoji] = len(item['voters'].get(reaction.emoji, ()))
 
     @commands.Cog.listener()
     async def on_reaction_remove(self, payload, user):
@@ -440,6 +882,9 @@ class Twitter(commands.Cog, name='Twitter', description="Twitter Interaction"):
         if not await self.check_permission(user):
             return
 
+        if candidate['action'] == 'digest':
+            return self._handle_digest_removal(payload, user, candidate)
+
         candidate['votes'][payload.emoji] -= 1
         # member = payload.message.author # type: discord.Member
         # emoji = payload.emoji
@@ -0,0 +1,75 @@
+import asyncio
+import os
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+class ConfigWatcher:
+    """Calls `callback` after the config file changes on disk.
+
+    Uses inotify when inotify_simple is installed, watching the directory so editors that save by renaming a new file
+    over the old one are noticed too, and falls back to polling the file's mtime. Bursts of events are coalesced."""
+
+    def __init__(self, loop, path, callback, interval=2.0, settle=0.5):
+        self.loop = loop
+        self.path = os.path.abspath(path)
+        self.callback = callback
+        self.interval = interval
+        self.settle = settle
+        self.inotify = None
+        self.poller = None
+        self.pending = None
+
+    def start(self):
+        if INotify is not None:
+            try:
+                self.inotify = INotify()
+                self.inotify.add_watch(os.path.dirname(self.path), flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE)
+                self.loop.add_reader(self.inotify.fileno(), self._on_inotify)
+                return
+            except OSError as e:
+                print('inotify is unavailable, polling config.yaml instead.', e)
+                self.inotify = None
+
+        self.poller = self.loop.create_task(self._poll())
+
+    def _on_inotify(self):
+        name = os.path.basename(self.path)
+        if any(event.name == name for event in self.inotify.read(timeout=0)):
+            self._changed()
+
+    def _stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+
+        return stat.st_mtime_ns, stat.st_size
+
+    async def _poll(self):
+        stamp = self._stamp()
+        while True:
+            await asyncio.sleep(self.interval)
+            if (current := self._stamp()) != stamp:
+                stamp = current
+                self._changed()
+
+    def _changed(self):
+        # Wait for the writer to finish before reading
+        if self.pending:
+            self.pending.cancel()
+
+        self.pending = self.loop.call_later(self.settle, lambda: self.loop.create_task(self.callback()))
+
+    def stop(self):
+        if self.pending:
+            self.pending.cancel()
+
+        if self.inotify:
+            self.loop.remove_reader(self.inotify.fileno())
+            self.inotify.close()
+
+        if self.poller:
+            self.poller.cancel()
@@ -0,0 +1,44 @@
+import hashlib
+import json
+import time
+
+class CredentialCache:
+    """Remembers which credential sets passed verify_credentials recently, so restarts can skip the round trip.
+
+    Only a hash of each credential set is written to disk, never the keys themselves."""
+
+    def __init__(self, path='.credentials_cache.json', ttl=21600):
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}
+
+        try:
+            with open(self.path) as file:
+                self.entries = json.load(file)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    @staticmethod
+    def key(credentials: dict):
+        fields = ('API Key', 'API Secret', 'Access Token', 'Access Secret')
+        return hashlib.sha256('\0'.join(str(credentials.get(f, '')) for f in fields).encode()).hexdigest()
+
+    def is_fresh(self, credentials: dict):
+        validated = self.entries.get(self.key(credentials))
+        return validated is not None and time.time() - validated < self.ttl
+
+    def store(self, credentials: dict):
+        self.entries[self.key(credentials)] = time.time()
+
+    def discard(self, credentials: dict):
+        self.entries.pop(self.key(credentials), None)
+
+    def save(self):
+        now = time.time()
+        self.entries = {k: v for k, v in self.entries.items() if now - v < self.ttl}
+
+        try:
+            with open(self.path, 'w') as file:
+                json.dump(self.entries, file)
+        except OSError as e:
+            print('Failed to save credential cache', e)
@@ -0,0 +1,88 @@
+import asyncio
+import inspect
+import itertools
+import time
+from collections import defaultdict, deque
+
+import telemetry
+
+class GuildScheduler:
+    """Weighted fair queuing of bot work across guilds.
+
+    Every job gets a virtual finish time of max(now, the guild's last finish) + cost / weight; the job with the
+    earliest finish time runs next, as long as its guild is under its own concurrency limit and the bot is under
+    the global one. A guild flooding the queue only pushes its own finish times further out."""
+
+    def __init__(self, loop, quota=None, concurrency=8):
+        self.loop = loop
+        self.quota = quota or (lambda guild_id: {})
+        self.concurrency = concurrency
+        self.queues = defaultdict(deque)
+        self.finish = defaultdict(float)
+        self.running = defaultdict(int)
+        self.active = 0
+        self.virtual_time = 0.0
+        self.counter = itertools.count()
+
+    def _limits(self, guild_id):
+        quota = self.quota(guild_id) or {}
+        return max(quota.get('weight', 1), 0.01), max(quota.get('concurrency', 2), 1)
+
+    async def run(self, guild_id, kind, function, *args, cost=1, **kwargs):
+        """Runs `function(*args, **kwargs)` (sync or async) in its guild's turn and returns its result"""
+        weight, _ = self._limits(guild_id)
+        tag = max(self.virtual_time, self.finish[guild_id]) + cost / weight
+        self.finish[guild_id] = tag
+
+        future = self.loop.create_future()
+        self.queues[guild_id].append((tag, next(self.counter), kind, function, args, kwargs, future, time.perf_counter()))
+        telemetry.guild_queue_depth.set(len(self.queues[guild_id]), guild=guild_id)
+        self._dispatch()
+
+        return await future
+
+    def _dispatch(self):
+        while self.active < self.concurrency:
+            best = None
+            for guild_id, queue in self.queues.items():
+                # Callers that gave up (cancelled) leave dead entries at the head
+                while queue and queue[0][6].done():
+                    queue.popleft()
+
+                if queue and self.running[guild_id] < self._limits(guild_id)[1]:
+                    if best is None or queue[0][:2] < self.queues[best][0][:2]:
+                        best = guild_id
+
+            if best is None:
+                return
+
+            job = self.queues[best].popleft()
+            telemetry.guild_queue_depth.set(len(self.queues[best]), guild=best)
+            if not self.queues[best]:
+                del self.queues[best]
+
+            self.virtual_time = job[0]
+            self.running[best] += 1
+            self.active += 1
+            self.loop.create_task(self._execute(best, job))
+
+    async def _execute(self, guild_id, job):
+        tag, _, kind, function, args, kwargs, future, enqueued = job
+        telemetry.guild_queue_time.observe(time.perf_counter() - enqueued, guild=guild_id, kind=kind)
+        try:
+            result = function(*args, **kwargs)
+            if inspect.isawaitable(result):
+                result = await result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+        finally:
+            self.running[guild_id] -= 1
+            self.active -= 1
+            self._dispatch()
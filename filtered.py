@@ -0,0 +1,156 @@
+import asyncio
+from types import SimpleNamespace
+
+import tweepy
+from tweepy.asynchronous import AsyncStreamingClient
+import rules
+import telemetry
+from tracing import tracer
+
+MAX_RULE = 512  # Characters per rule on the standard filtered-stream tier
+
+def negate(text):
+    # Twitter can't negate a group; an ignored phrase is matched as one locally anyway
+    return '-' + rules.search_word(text) if len(text.split()) == 1 else '-"' + text.replace('"', '') + '"'
+
+def build_rule(terms, ignore, me):
+    """One filtered-stream rule for a guild: its terms, minus retweets, replies, its own Tweets and what it ignores.
+
+    Ignore entries Twitter can't express (patterns, cashtag counts, quoted text) or that don't fit in the rule are
+    left to the local matcher, which still sees every Tweet."""
+    value = f"({rules.search_query(terms)}) -is:retweet -is:reply -from:{me}"
+    if len(value) > MAX_RULE:
+        raise ValueError(f'The search terms make a {len(value)} character rule; filtered streams allow {MAX_RULE}')
+
+    for entry in ignore:
+        try:
+            kind, ignored = rules.parse(entry)
+        except ValueError:
+            continue
+
+        negation = {'author': f'-from:{ignored}', 'text': negate(ignored), 'word': negate(ignored)}.get(kind)
+        if negation and len(value) + len(negation) + 1 <= MAX_RULE:
+            value += ' ' + negation
+
+    return value
+
+def to_status(tweet, includes):
+    """The parts of a v1.1 Status that stream_to_channel reads, from a v2 Tweet and its expansions"""
+    users = {user.id: user for user in includes.get('users', [])}
+    tweets = {included.id: included for included in includes.get('tweets', [])}
+
+    author = users.get(tweet.author_id)
+    quoted = next((tweets.get(ref.id) for ref in tweet.referenced_tweets or [] if ref.type == 'quoted'), None)
+
+    return SimpleNamespace(
+        id=tweet.id,
+        text=tweet.text,
+        truncated=False,
+        extended_tweet={'full_text': tweet.text},
+        author=SimpleNamespace(screen_name=author.username if author else str(tweet.author_id)),
+        quoted_status=SimpleNamespace(text=quoted.text, extended_tweet={'full_text': quoted.text}) if quoted else None
+    )
+
+class FilteredStream(AsyncStreamingClient):
+    """One v2 filtered-stream connection shared by every guild.
+
+    Each guild's search is a rule tagged with its id. Changing terms or mutes adds and deletes only the rules that
+    differ; the connection itself stays up."""
+
+    def __init__(self, bearer_token, **kwargs):
+        super().__init__(bearer_token, **kwargs)
+        self.guilds = {}
+        self.connected = asyncio.Event()
+        self.lock = asyncio.Lock()
+
+    async def on_connect(self):
+        self.connected.set()
+
+    async def on_disconnect(self):
+        self.connected.clear()
+
+    def attach(self, guild_id, account, channel, callback, search):
+        stream = self.guilds[guild_id] = GuildRule(self, guild_id, account, channel, callback, search)
+        if self.task is None or self.task.done():
+            self.filter(expansions=['author_id', 'referenced_tweets.id'],
+                        tweet_fields=['author_id', 'referenced_tweets'], user_fields=['username'])
+
+        return stream
+
+    async def on_response(self, response):
+        if response.data is None:
+            return
+
+        status = to_status(response.data, response.includes)
+        for tag in {rule.tag for rule in response.matching_rules}:
+            if not (stream := self.guilds.get(int(tag))) or not stream.running:
+                continue
+
+            telemetry.stream_messages.inc(guild=stream.guild_id, stage='received')
+            with tracer.span('on_response', trace_id=tracer.new_trace(), guild=stream.guild_id):
+                await stream.callback(stream.channel, status)
+
+    async def sync(self):
+        """Adds and deletes rules until Twitter has exactly one per attached guild"""
+        async with self.lock:
+            if self.session is not None and self.session.closed:
+                self.session = None  # Closed with the last connection; the rules endpoints open a new one
+
+            wanted = set()
+            for guild_id, stream in self.guilds.items():
+                search = stream.search()
+                if not stream.running or not search.get('terms'):
+                    continue
+
+                try:
+                    wanted.add((build_rule(search['terms'], search.get('ignore', []), stream.me), str(guild_id)))
+                except ValueError as e:
+                    print(f'Skipping the stream rule of {guild_id}.', e)
+
+            current = (await self.get_rules()).data or []
+            stale = [rule.id for rule in current if (rule.value, rule.tag) not in wanted]
+            existing = {(rule.value, rule.tag) for rule in current}
+            missing = [tweepy.StreamRule(value, tag) for value, tag in wanted if (value, tag) not in existing]
+
+            if stale:
+                await self.delete_rules(stale)
+            if missing:
+                response = await self.add_rules(missing)
+                for error in response.errors:
+                    telemetry.errors.inc(where='stream_rules')
+                    print('Failed to add a stream rule.', error)
+
+            return len(missing), len(stale)
+
+class GuildRule:
+    """A guild's share of the FilteredStream, standing in for its own stream connection"""
+
+    def __init__(self, client, guild_id, account, channel, callback, search):
+        self.client = client
+        self.guild_id = guild_id
+        self.me = account
+        self.channel = channel
+        self.callback = callback
+        self.search = search
+        self.running = True
+        self.connected = client.connected
+
+    async def sync(self):
+        return await self.client.sync()
+
+    async def disconnect(self):
+        self.running = False
+        if self.client.guilds.get(self.guild_id) is self:
+            del self.client.guilds[self.guild_id]
+
+        try:
+            await self.client.sync()
+        except Exception as e:
+            # Its rule stays on Twitter until the next sync, but the guild no longer receives anything
+            telemetry.errors.inc(where='stream_rules')
+            print(f'Failed to remove the stream rule of {self.guild_id}.', e)
+
+        if not self.client.guilds:
+            # The last guild left; attaching another one connects again
+            self.client.disconnect()
+            self.client.connected.clear()
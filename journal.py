@@ -0,0 +1,151 @@
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import telemetry
+
+def transient(error):
+    """Whether an action that failed this way may succeed if tried again"""
+    import requests
+    import tweepy
+
+    if isinstance(error, tweepy.HTTPException):
+        return isinstance(error, tweepy.TwitterServerError)
+
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code >= 500
+
+    # Timeouts and dropped connections; tweepy wraps these in a bare TweepyException
+    return isinstance(error, (tweepy.TweepyException, requests.ConnectionError, requests.Timeout, OSError, asyncio.TimeoutError))
+
+class ActionJournal:
+    """Append-only JSONL log of passed actions: an intent before the first attempt, then failures and the outcome.
+
+    Before every retry the action's `verify` is asked whether the earlier attempt took effect after all (the request
+    may have timed out after Twitter handled it), so a retry never posts, likes or submits twice. Intents without an
+    outcome are still pending after a restart and can be resumed."""
+
+    def __init__(self, loop, path='actions.jsonl', attempts=5, backoff=2.0):
+        self.loop = loop
+        self.path = path
+        self.attempts = attempts
+        self.backoff = backoff
+        # One thread keeps the lines in order and the fsyncs off the event loop
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='journal')
+        self.running = set()
+
+    def _append(self, entry):
+        with open(self.path, 'a') as file:
+            file.write(json.dumps(entry) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+    def write(self, action_id, event, **fields):
+        entry = {'id': action_id, 'time': time.time(), 'event': event, **fields}
+        return self.loop.run_in_executor(self.executor, self._append, entry)
+
+    async def pending(self):
+        """Intents without an outcome that aren't being run right now, oldest first"""
+        # On the journal's thread, so rewriting the file can't race an append
+        entries = await self.loop.run_in_executor(self.executor, self._compact)
+        return [entry for entry in entries if entry['id'] not in self.running]
+
+    def _compact(self):
+        """Rewrites the journal down to the intents without an outcome, and returns those"""
+        entries = {}
+        try:
+            with open(self.path) as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # A line cut short by a crash
+
+                    if entry['event'] == 'intent':
+                        entries[entry['id']] = entry
+                    elif entry['event'] in ('done', 'abandoned'):
+                        entries.pop(entry['id'], None)
+        except OSError:
+            return []
+
+        with open(f'{self.path}.tmp', 'w') as file:
+            file.writelines(json.dumps(entry) + '\n' for entry in entries.values())
+        os.replace(f'{self.path}.tmp', self.path)
+
+        return list(entries.values())
+
+    async def _verify(self, action_id, kind, verify):
+        """(result, known); unknown when the check itself failed, in which case the action must not be sent again"""
+        try:
+            return await verify(), True
+        except Exception as e:
+            telemetry.errors.inc(where=f'journal_{kind}')
+            await self.write(action_id, 'unverified', error=repr(e))
+            return e, False
+
+    async def run(self, kind, perform, verify, action_id=None, **context):
+        """Runs `perform()` until it succeeds, it fails permanently or attempts run out.
+
+        `verify()` returns the action's result if it has already taken effect, else None. A resumed action (given
+        the `action_id` of its pending intent) is verified before anything is sent."""
+        resumed = action_id is not None
+        action_id = action_id or uuid.uuid4().hex
+
+        # Queued or retrying actions are still in the journal as intents; resuming them would send them twice
+        self.running.add(action_id)
+        try:
+            if not resumed:
+                await self.write(action_id, 'intent', kind=kind, **context)
+
+            return await self._run(action_id, kind, perform, verify, resumed)
+        finally:
+            self.running.discard(action_id)
+
+    async def _run(self, action_id, kind, perform, verify, resumed):
+        import tweepy
+
+        error = None
+        for attempt in range(self.attempts):
+            if attempt:
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1) + random.uniform(0, 1))
+
+            if attempt or resumed:
+                result, known = await self._verify(action_id, kind, verify)
+                if not known:
+                    error = result
+                    continue
+                if result is not None:
+                    await self.write(action_id, 'done', result=getattr(result, 'id', None), recovered=True)
+                    return result
+
+            try:
+                result = await perform()
+            except Exception as e:
+                error = e
+                telemetry.errors.inc(where=f'journal_{kind}')
+                await self.write(action_id, 'failed', attempt=attempt, error=repr(e))
+
+                # A refusal can mean it already happened (duplicate status, already liked), which verify can tell
+                if isinstance(e, tweepy.Forbidden):
+                    result, known = await self._verify(action_id, kind, verify)
+                    if known and result is not None:
+                        await self.write(action_id, 'done', result=getattr(result, 'id', None), recovered=True)
+                        return result
+                    break
+
+                if not transient(e):
+                    break
+                continue
+
+            await self.write(action_id, 'done', result=getattr(result, 'id', None))
+            return result
+
+        await self.write(action_id, 'abandoned', error=repr(error))
+        raise error
+
+    def close(self):
+        self.executor.shutdown(wait=True)
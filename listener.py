@@ -0,0 +1,46 @@
+import asyncio
+import json
+from tweepy import asynchronous
+import telemetry
+from tracing import tracer
+
+class MyStreamListener(asynchronous.AsyncStream):
+    def __init__(self, account, channel, callback, **kwargs):
+        super().__init__(**kwargs)
+        self.me = account
+        self.channel = channel
+        self.callback = callback
+        self.running = True
+        self.connected = asyncio.Event()
+
+    async def on_connect(self):
+        self.connected.set()
+
+    async def on_data(self, raw_data):
+        if not self.running:
+            return
+
+        telemetry.stream_messages.inc(guild=self.channel.guild.id, stage='received')
+
+        with tracer.span('on_data', trace_id=tracer.new_trace(), guild=self.channel.guild.id):
+            data = json.loads(raw_data)
+            if data.get("in_reply_to_status_id") or data.get('retweeted_status'):
+                telemetry.stream_messages.inc(guild=self.channel.guild.id, stage='filtered')
+                return
+
+            await super().on_data(raw_data)
+
+    async def on_status(self, status):
+        if self.running and status.author.screen_name != self.me:
+            if not hasattr(status, 'quoted_status'):
+                status.quoted_status = None
+                status.quoted_status_id = None
+
+            if status.quoted_status and not hasattr(status.quoted_status, 'extended_tweet'):
+                status.quoted_status.extended_tweet = {}
+
+            await self.callback(self.channel, status)
+
+    async def disconnect(self):
+        self.running = False
+        super().disconnect()
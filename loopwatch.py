@@ -0,0 +1,116 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+import telemetry
+
+class LoopWatchdog:
+    """Measures event loop scheduling lag, and captures the loop thread's stack when it stalls.
+
+    A heartbeat task on the loop records when it last ran; a daemon thread notices when the heartbeat is
+    late by more than `threshold` seconds and snapshots whatever the loop thread is executing at the time."""
+
+    def __init__(self, loop, threshold=0.25, interval=0.1, keep=25):
+        self.loop = loop
+        self.threshold = threshold
+        self.interval = interval
+        self.incidents = deque(maxlen=keep)
+        self.lag = 0.0
+        self.heartbeat = time.monotonic()
+        self.loop_thread = None
+        self.current = None
+        self.task = None
+        self.thread = None
+        self.root = os.path.dirname(os.path.abspath(__file__))
+
+    def start(self):
+        if self.task:
+            return
+
+        self.task = self.loop.create_task(self._beat())
+        self.thread = threading.Thread(target=self._watch, name='moobird-watchdog', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def _beat(self):
+        # Time spent before the loop started (loading extensions, ...) isn't a stall
+        self.heartbeat = time.monotonic()
+        self.loop_thread = threading.get_ident()
+        while True:
+            expected = self.loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+
+            self.lag = max(0.0, self.loop.time() - expected)
+            self.heartbeat = time.monotonic()
+            telemetry.loop_lag.set(self.lag)
+
+            if incident := self.current:
+                self.current = None
+                incident['duration'] = self.lag
+                print(f"Event loop blocked for {incident['duration']:.3f}s in {incident['handler']} "
+                      f"(guild: {incident['guild'] or 'n/a'})\n{''.join(incident['stack'])}")
+
+    def _watch(self):
+        while self.task and not self.task.done():
+            time.sleep(self.interval / 2)
+
+            stalled = time.monotonic() - self.heartbeat - self.interval
+            if stalled < self.threshold or self.current or not self.loop_thread:
+                continue
+
+            if not (frame := sys._current_frames().get(self.loop_thread)):
+                continue
+
+            self.current = self._capture(frame, stalled)
+            self.incidents.append(self.current)
+
+    def _capture(self, frame, stalled):
+        stack = traceback.extract_stack(frame)
+        handler = None
+        guild = None
+
+        # The innermost frame is usually library code (ssl, yaml, requests); name the bot code that called it
+        while frame is not None:
+            if handler is None and frame.f_code.co_filename.startswith(self.root):
+                module = os.path.relpath(frame.f_code.co_filename, self.root)
+                handler = f'{module}:{frame.f_code.co_name}'
+
+            if guild is None:
+                guild = self._guild_of(frame.f_locals)
+
+            if handler and guild:
+                break
+
+            frame = frame.f_back
+
+        return {
+            'time'    : time.time(),
+            'duration': stalled,
+            'handler' : handler or (stack[-1].name if stack else 'unknown'),
+            'guild'   : guild,
+            'stack'   : traceback.format_list(stack),
+        }
+
+    @staticmethod
+    def _guild_of(local_vars):
+        if isinstance(guild_id := local_vars.get('guild_id'), int):
+            return str(guild_id)
+
+        for name in ('guild', 'ctx', 'message', 'channel', 'reaction', 'user'):
+            value = local_vars.get(name)
+            guild = value if name == 'guild' else getattr(value, 'guild', None)
+            if guild is None and name == 'reaction':
+                guild = getattr(getattr(value, 'message', None), 'guild', None)
+
+            if guild is not None and hasattr(guild, 'id'):
+                return f'{getattr(guild, "name", "")} ({guild.id})'
+
+        return None
@@ -0,0 +1,217 @@
+import asyncio
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+MB = 1024 * 1024
+LIMITS = {'image': 5 * MB, 'gif': 15 * MB, 'video': 15 * MB}
+
+class MediaError(Exception):
+    pass
+
+def kind_of(content_type):
+    content_type = content_type or ''
+    if 'video' in content_type:
+        return 'video'
+    if 'gif' in content_type:
+        return 'gif'
+    return 'image'
+
+def can_shrink(content_type):
+    """Whether the tools needed to fit this kind of media under Twitter's limits are installed"""
+    if kind_of(content_type) == 'video':
+        return bool(shutil.which('ffmpeg') and shutil.which('ffprobe'))
+
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        return False
+
+    return True
+
+# The functions below run in worker processes, so they only take and return plain bytes and strings
+
+def _shrink_image(data, limit):
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data))
+    keep_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    image = image.convert('RGBA' if keep_alpha else 'RGB')
+
+    while True:
+        for quality in (90, 80, 70, 60, 50):
+            output = io.BytesIO()
+            if keep_alpha:
+                image.save(output, format='PNG', optimize=True)
+            else:
+                image.save(output, format='JPEG', quality=quality, optimize=True, progressive=True)
+
+            if output.tell() <= limit:
+                return output.getvalue(), 'image/png' if keep_alpha else 'image/jpeg'
+
+            if keep_alpha:
+                break
+
+        if min(image.size) < 64:
+            raise MediaError('Unable to shrink this image under the size limit')
+
+        image = image.resize((int(image.width * 0.75), int(image.height * 0.75)), Image.LANCZOS)
+
+def _shrink_gif(data, limit):
+    from PIL import Image, ImageSequence
+
+    source = Image.open(io.BytesIO(data))
+    frames = [frame.copy() for frame in ImageSequence.Iterator(source)]
+    durations = [frame.info.get('duration', source.info.get('duration', 100)) for frame in frames]
+    scale = 1.0
+
+    while True:
+        size = (int(source.width * scale), int(source.height * scale))
+        resized = [frame.convert('RGBA').resize(size, Image.LANCZOS).convert('P', palette=Image.ADAPTIVE) for frame in frames]
+
+        output = io.BytesIO()
+        resized[0].save(output, format='GIF', save_all=True, append_images=resized[1:], optimize=True,
+                        duration=durations, loop=source.info.get('loop', 0), disposal=2)
+        if output.tell() <= limit:
+            return output.getvalue(), 'image/gif'
+
+        if min(size) < 64:
+            raise MediaError('Unable to shrink this GIF under the size limit')
+
+        scale *= 0.75
+
+def _transcode_video(data, limit):
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, 'source')
+        target = os.path.join(directory, 'target.mp4')
+        with open(source, 'wb') as file:
+            file.write(data)
+
+        probe = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'json', source],
+                               capture_output=True, check=True)
+        duration = float(json.loads(probe.stdout)['format']['duration'])
+
+        # Leave headroom for the container and audio track
+        audio_bitrate = 128_000
+        video_bitrate = int(limit * 8 * 0.9 / duration) - audio_bitrate
+        if video_bitrate < 100_000:
+            raise MediaError('This video is too long to fit under the size limit')
+
+        subprocess.run(['ffmpeg', '-y', '-v', 'error', '-i', source,
+                        '-vf', "scale='min(1280,iw)':-2", '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p',
+                        '-b:v', str(video_bitrate), '-maxrate', str(video_bitrate), '-bufsize', str(video_bitrate * 2),
+                        '-c:a', 'aac', '-b:a', str(audio_bitrate), '-movflags', '+faststart', target],
+                       capture_output=True, check=True)
+
+        with open(target, 'rb') as file:
+            output = file.read()
+
+    if len(output) > limit:
+        raise MediaError('Unable to shrink this video under the size limit')
+
+    return output, 'video/mp4'
+
+def shrink(data, content_type, filename):
+    kind = kind_of(content_type)
+    limit = LIMITS[kind]
+    if len(data) <= limit:
+        return data, content_type, filename
+
+    data, content_type = {'image': _shrink_image, 'gif': _shrink_gif, 'video': _transcode_video}[kind](data, limit)
+    extension = content_type.split('/')[1].replace('jpeg', 'jpg')
+    return data, content_type, f'{os.path.splitext(filename)[0]}.{extension}'
+
+class UploadCache:
+    """Twitter media ids of uploaded attachments, keyed by (account, sha256 of the original file).
+
+    Attachment ids are mapped to their hash once downloaded, so proposing the same attachment again skips the download
+    too. Holds at most `size` entries, least recently used first out, and drops media ids `margin` seconds before
+    Twitter expires them."""
+
+    def __init__(self, size=500, margin=600):
+        self.size = size
+        self.margin = margin
+        self.entries = OrderedDict()
+        self.digests = OrderedDict()
+
+    def _bound(self, entries):
+        while len(entries) > self.size:
+            entries.popitem(last=False)
+
+    def digest_of(self, attachment_id):
+        return self.digests.get(attachment_id)
+
+    def remember(self, attachment_id, digest):
+        self.digests[attachment_id] = digest
+        self.digests.move_to_end(attachment_id)
+        self._bound(self.digests)
+
+    def get(self, account, digest):
+        if (entry := self.entries.get((account, digest))) is None:
+            return None
+
+        media_id, expires = entry
+        if expires <= time.time():
+            del self.entries[(account, digest)]
+            return None
+
+        self.entries.move_to_end((account, digest))
+        return media_id
+
+    def put(self, account, digest, media_id, expires_after):
+        self.entries[(account, digest)] = (media_id, time.time() + expires_after - self.margin)
+        self.entries.move_to_end((account, digest))
+        self._bound(self.entries)
+
+def digest_of(data):
+    return hashlib.sha256(data).hexdigest()
+
+class MediaPreparer:
+    """Downloads attachments and fits them under Twitter's limits in a process pool, away from the event loop.
+
+    Each prepared attachment is (data, content_type, filename, digest); data is None when `account` already has it
+    uploaded, according to `uploads`."""
+
+    def __init__(self, loop, workers=2, cache_size=500):
+        self.loop = loop
+        self.workers = workers
+        self.pool = None
+        self.uploads = UploadCache(cache_size)
+
+    def _executor(self):
+        if self.pool is None:
+            # spawn, not fork: the bot process has live threads (watchdog, executors) that must not be forked
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+        return self.pool
+
+    async def prepare(self, attachment, account=None):
+        if (digest := self.uploads.digest_of(attachment.id)) and self.uploads.get(account, digest):
+            return None, attachment.content_type, attachment.filename, digest
+
+        data = await attachment.read()
+        digest = await self.loop.run_in_executor(None, digest_of, data)
+        self.uploads.remember(attachment.id, digest)
+        if self.uploads.get(account, digest):
+            # Same file, uploaded from another message or guild on this account
+            return None, attachment.content_type, attachment.filename, digest
+
+        if len(data) <= LIMITS[kind_of(attachment.content_type)]:
+            return data, attachment.content_type, attachment.filename, digest
+
+        return (*await self.loop.run_in_executor(self._executor(), shrink, data, attachment.content_type, attachment.filename), digest)
+
+    async def prepare_all(self, attachments, account=None):
+        return await asyncio.gather(*(self.prepare(attachment, account) for attachment in attachments))
+
+    def shutdown(self):
+        if self.pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
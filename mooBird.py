@@ -1,34 +1,72 @@
+import asyncio
+import hashlib
+import json
 import os
+import time
+from collections import Counter
 import discord
-import tweepy
 import yaml
 from discord.ext import tasks, commands
+import telemetry
+from tracing import tracer
+from loopwatch import LoopWatchdog
+from credentials import CredentialCache
+from scheduler import ActionScheduler
+from rules import Matcher, parse
+from media import MediaPreparer
+from fairshare import GuildScheduler
+from relay import WebhookRelay
+from analytics import Analytics
+from configwatch import ConfigWatcher
+from journal import ActionJournal
+
+CONFIG_PATH = 'config.yaml'
 
 class MooBird(commands.Bot):
     tweet_candidates = {}
     response_options = ['👍', '👎']
     interaction_options = ['🤍', '🔇', '🐮']
     interaction_confirm = ['♥️', '🤐', '🚀']
+    digest_options = ['1️⃣', '2️⃣', '3️⃣', '4️⃣', '5️⃣', '6️⃣', '7️⃣', '8️⃣', '9️⃣', '🔟']
     twitterApi = {}
     streams = {}
+    schedulers = {}
+    matchers = {}
+    rule_hits = {}
 
     def __init__(self, config):
         self.api_key = config.get('discord_key')
         self.config = config.get('config')
+        # Bot-wide options (metrics, ...) live beside `config` at the top of config.yaml
+        self.settings = {k: v for k, v in config.items() if k not in ('discord_key', 'config')}
 
         intents = discord.Intents.default()
         intents.members = True
         super().__init__(command_prefix=self.handle_prefix, case_insensitive=True, intents=intents)
 
         self.help_command = commands.DefaultHelpCommand(command_attrs={"hidden": True})
+        telemetry.instrument_http(self.http)
+        tracer.configure(**self.settings.get('tracing', {}))
+        self.watchdog = LoopWatchdog(self.loop, **self.settings.get('watchdog', {}))
+        self.credential_cache = CredentialCache(**self.settings.get('credential_cache', {}))
+        self.media = MediaPreparer(self.loop, **self.settings.get('media', {}))
+        self.work = GuildScheduler(self.loop, quota=lambda guild_id: self.config.get(guild_id, {}).get('quota'),
+                                   **self.settings.get('fairshare', {}))
+        self.config_dirty = False
+        self.relay = WebhookRelay(self)
+        self.analytics = Analytics(self.loop, **self.settings.get('analytics', {}))
+        self.journal = ActionJournal(self.loop, **self.settings.get('journal', {}))
+        # Reloading the Twitter cog must not resume the journal again
+        self.journal_resumed = False
+        self.config_watcher = None
+        self.config_digest = None
+        # Servers as of the last read or write of config.yaml; ones added since aren't missing from the file, just unsaved
+        self.file_guilds = set(self.config)
+        self.validations = {}
+        self.deferred = {}
+        self.extension_timings = {}
         # default_channel = config['channels'][0] if len(config['channels']) else None
 
-        for guild_id, config in self.config.items():
-            if api := self.validate_credentials(config.get('credentials', {})):
-                self.twitterApi[guild_id] = api
-            else:
-                config['credentials'] = {}
-
     def create_config(self, guild_id):
         skel = {
             'credentials': {},
@@ -47,28 +85,257 @@ class MooBird(commands.Bot):
 
         self.config[guild_id] = skel
 
-    def save_config(self):
-        with open(r'config.yaml', 'w') as file:
-            yaml.dump({'discord_key': self.api_key, 'config': self.config}, file)
+    def save_config(self, guild_id=None):
+        """Queues a write of config.yaml in the guild's turn; changes made before it runs share the one write"""
+        if self.config_dirty:
+            return
+
+        self.config_dirty = True
+        self.loop.create_task(self.work.run(guild_id or 0, 'config', self.flush_config))
+
+    def flush_config(self):
+        if not self.config_dirty:
+            return
+
+        self.config_dirty = False
+        text = yaml.dump({'discord_key': self.api_key, 'config': self.config, **self.settings})
+        # Remembered so the config watcher can tell this write from an operator's edit
+        self.config_digest = hashlib.sha256(text.encode()).hexdigest()
+        try:
+            with open(CONFIG_PATH, 'w') as file:
+                file.write(text)
+        except OSError as e:
+            telemetry.errors.inc(where='config')
+            print('Failed to write config.yaml.', e)
+            return
+
+        self.file_guilds = set(self.config)
+        telemetry.config_flushes.inc()
 
     @staticmethod
-    def validate_credentials(credentials : dict):
+    def check_config(data):
+        """Raises ValueError naming the first problem in a loaded config.yaml"""
+        if not isinstance(data, dict) or not isinstance(data.get('config'), dict):
+            raise ValueError('`config` must map server ids to their settings')
+
+        for guild_id, config in data['config'].items():
+            if not isinstance(guild_id, int) or not isinstance(config, dict):
+                raise ValueError(f'`{guild_id}` must be a server id with its settings')
+
+            for key, kind in (('credentials', dict), ('allowed', dict), ('search', dict), ('votes_needed', int)):
+                if not isinstance(config.get(key), kind):
+                    raise ValueError(f'`{key}` of {guild_id} must be a {kind.__name__}')
+
+            if not isinstance(config['search'].get('terms', []), list):
+                raise ValueError(f'`search.terms` of {guild_id} must be a list')
+
+            for entry in config['search'].get('ignore', []):
+                parse(entry)
+
+    async def reload_config(self):
+        """Applies edits made to config.yaml while running, touching only the servers whose settings changed"""
+        start = time.perf_counter()
+        try:
+            with open(CONFIG_PATH, 'rb') as file:
+                raw = file.read()
+        except OSError as e:
+            print('Failed to read config.yaml.', e)
+            return
+
+        if (digest := hashlib.sha256(raw).hexdigest()) == self.config_digest:
+            return
+
+        try:
+            data = yaml.safe_load(raw)
+            self.check_config(data)
+        except (yaml.YAMLError, ValueError) as e:
+            telemetry.errors.inc(where='config_reload')
+            print('Ignoring invalid config.yaml.', e)
+            return
+
+        self.config_digest = digest
+        previous, self.file_guilds = self.file_guilds, set(data['config'])
+        changed = []
+        for guild_id in self.config.keys() | data['config'].keys():
+            old, new = self.config.get(guild_id), data['config'].get(guild_id)
+            if new is None and guild_id not in previous:
+                continue  # Joined since the last write
+
+            if old and new and (since_id := old['search'].get('since_id')):
+                # The stream checkpoint moves on while the file is being edited; keep the newer one
+                new['search']['since_id'] = max(since_id, new['search'].get('since_id') or 0)
+
+            if old != new:
+                changed.append(guild_id)
+                self.apply_guild_config(guild_id, old or {}, new)
+
+        settings = {k: v for k, v in data.items() if k not in ('discord_key', 'config')}
+        changed_settings = sorted(k for k in settings.keys() | self.settings.keys() if settings.get(k) != self.settings.get(k))
+        self.settings.clear()
+        self.settings.update(settings)
+
+        elapsed = time.perf_counter() - start
+        telemetry.config_reload.set(elapsed)
+        print(f'Reloaded config.yaml in {elapsed * 1000:.1f}ms: {len(changed)} servers changed'
+              + (f", options changed: {', '.join(changed_settings)} (some only apply after a restart)" if changed_settings else ''))
+
+    def apply_guild_config(self, guild_id, old, new):
+        if new is None:
+            self.config.pop(guild_id, None)
+        else:
+            self.config[guild_id] = new
+
+        # Rebuilt on next use from the new ignore list
+        self.matchers.pop(guild_id, None)
+
+        if old.get('credentials') != (new or {}).get('credentials'):
+            self.twitterApi.pop(guild_id, None)
+            if new:
+                self.validations[guild_id] = self.loop.create_task(self.validate_guild(guild_id))
+
+        if new and new['search'].get('enabled'):
+            self.ensure_extension('commands.stream')
+
+        # Cogs holding per-guild state (streams, ...) pick out what concerns them
+        self.dispatch('config_change', guild_id, old, new or {})
+
+    def validate_credentials(self, credentials: dict, cached=False):
         if not credentials:
             return None
 
+        import tweepy
+
         auth = tweepy.OAuthHandler(credentials['API Key'], credentials['API Secret'])
         auth.set_access_token(credentials['Access Token'], credentials['Access Secret'])
-        api = tweepy.API(auth)
+        api = telemetry.instrument_api(tweepy.API(auth))
+
+        if cached and self.credential_cache.is_fresh(credentials):
+            return api
 
         if api.verify_credentials():
+            self.credential_cache.store(credentials)
             return api
 
+        self.credential_cache.discard(credentials)
         return None
 
+    async def validate_guild(self, guild_id, retry=30):
+        import tweepy
+
+        config = self.config[guild_id]
+        credentials = config.get('credentials', {})
+
+        try:
+            api = await self.loop.run_in_executor(None, self.validate_credentials, credentials, True)
+        except tweepy.Unauthorized as e:
+            print(f'Twitter rejected the credentials of {guild_id}.', e)
+            api = None
+        except Exception as e:
+            # Twitter being unreachable says nothing about the credentials; keep them and try again later
+            telemetry.errors.inc(where='validate_credentials')
+            print(f'Failed to validate credentials for {guild_id}, retrying in {retry}s.', e)
+            self.loop.call_later(retry, self._revalidate, guild_id, credentials, min(retry * 2, 900))
+            return None
+
+        if api:
+            self.twitterApi[guild_id] = api
+        else:
+            config['credentials'] = {}
+
+        return api
+
+    def _revalidate(self, guild_id, credentials, retry):
+        if guild_id in self.twitterApi or self.config.get(guild_id, {}).get('credentials') != credentials:
+            return  # Validated or re-entered since
+
+        self.validations[guild_id] = self.loop.create_task(self.validate_guild(guild_id, retry))
+
+    async def validate_all(self):
+        """Validates every guild's credentials concurrently; each guild's Twitter features turn on as it passes"""
+        start = time.perf_counter()
+        for guild_id in self.config:
+            self.validations[guild_id] = self.loop.create_task(self.validate_guild(guild_id))
+
+        results = await asyncio.gather(*self.validations.values())
+        self.credential_cache.save()
+        print(f'Validated {sum(1 for api in results if api)}/{len(results)} credential sets in {time.perf_counter() - start:.2f}s')
+
     @staticmethod
     def list_cogs(directory):
         return (f"{directory}.{f.rstrip('py').rstrip('.')}" for f in os.listdir(directory) if f.endswith('.py'))
 
+    def scheduler(self, guild_id) -> ActionScheduler:
+        """The write-action queue of the account this guild posts through"""
+        api = self.twitterApi[guild_id]
+        account = telemetry.account_of(api)
+        if account not in self.schedulers:
+            self.schedulers[account] = ActionScheduler(api, self.loop, self.work)
+
+        # Credentials may have been re-entered since the scheduler was created
+        self.schedulers[account].api = api
+        return self.schedulers[account]
+
+    def matcher(self, guild_id) -> Matcher:
+        """The compiled ignore rules of a guild, rebuilt whenever its ignore list changes"""
+        entries = tuple(self.config[guild_id]['search'].get('ignore', []))
+        if (matcher := self.matchers.get(guild_id)) is None or matcher.entries != entries:
+            hits = self.rule_hits.setdefault(guild_id, Counter())
+            matcher = self.matchers[guild_id] = Matcher(entries, hits)
+
+        return matcher
+
+    @staticmethod
+    def read_manifest(directory):
+        """Commands provided by each extension, so they can be registered before the extension is imported"""
+        try:
+            with open(os.path.join(directory, 'manifest.json')) as file:
+                return json.load(file)
+        except (OSError, ValueError) as e:
+            print('Failed to read extension manifest.', e)
+            return {}
+
+    def defer_extension(self, name, command_names):
+        """Registers placeholder commands that load `name` on first use and then re-run the invocation"""
+        async def load_and_invoke(ctx, *, args=None):
+            self.ensure_extension(name)
+            await self.invoke(await self.get_context(ctx.message))
+
+        self.deferred[name] = command_names
+        for command_name in command_names:
+            self.add_command(commands.Command(load_and_invoke, name=command_name, hidden=True))
+
+    def ensure_extension(self, name):
+        if name in self.deferred:
+            self.load_extension(name)
+
+    def load_extension(self, name):
+        for command_name in self.deferred.pop(name, ()):
+            self.remove_command(command_name)
+
+        super().load_extension(name)
+
+    def _load_from_module_spec(self, spec, key):
+        # Split the cost of loading an extension into executing its module (imports) and its setup()
+        exec_module = spec.loader.exec_module
+        timings = {}
+
+        def timed_exec_module(module):
+            start = time.perf_counter()
+            try:
+                exec_module(module)
+            finally:
+                timings['import'] = time.perf_counter() - start
+
+        spec.loader.exec_module = timed_exec_module
+        start = time.perf_counter()
+        try:
+            super()._load_from_module_spec(spec, key)
+        finally:
+            timings['setup'] = time.perf_counter() - start - timings.get('import', 0)
+            self.extension_timings[key] = timings
+            for phase, seconds in timings.items():
+                telemetry.extension_load.set(seconds, extension=key, phase=phase)
+
     @staticmethod
     def handle_prefix(bot, message):
         if isinstance(message.channel, discord.channel.DMChannel):
@@ -79,6 +346,22 @@ class MooBird(commands.Bot):
     async def on_ready(self):
         await self.change_presence(activity=discord.Game(name='on Twitter'))
 
+        # Enabled streams resume on startup, so their extension can't wait for a command
+        if any(config.get('search', {}).get('enabled') for config in self.config.values()):
+            self.ensure_extension('commands.stream')
+
+    async def close(self):
+        # Stream checkpoints are only saved every so often; write the latest ones
+        self.config_dirty = True
+        self.flush_config()
+        self.relay.stop()
+        self.analytics.close()
+        self.journal.close()
+        self.media.shutdown()
+        if self.config_watcher:
+            self.config_watcher.stop()
+        await super().close()
+
     @staticmethod
     def parse_int(val):
         try:
@@ -89,9 +372,27 @@ class MooBird(commands.Bot):
         return val
 
     def exec(self):
+        start = time.perf_counter()
+        lazy = self.read_manifest('commands') if self.settings.get('lazy_load') else {}
+
         for cog in self.list_cogs('commands'):
+            if cog in lazy:
+                self.defer_extension(cog, lazy[cog])
+                continue
+
             try:
                 self.load_extension(cog)
             except Exception as e:
+                telemetry.errors.inc(where='load_extension')
                 print(f'Failed to load extension {cog}.', e)
+
+        print(f'Loaded {len(self.extensions)} extensions in {time.perf_counter() - start:.3f}s'
+              + (f', deferred {len(self.deferred)}' if self.deferred else ''))
+
+        self.watchdog.start()
+        if (options := self.settings.get('config_watch', {})).get('enabled', True):
+            self.config_watcher = ConfigWatcher(self.loop, CONFIG_PATH, self.reload_config, options.get('interval', 2.0))
+            self.config_watcher.start()
+
+        self.loop.create_task(self.validate_all())
         self.run(self.api_key)
@@ -0,0 +1,108 @@
+import asyncio
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+class SamplingProfiler:
+    """Periodically samples the stack of one thread (the event loop's) from a background thread.
+
+    Samples are kept as folded stacks, the input format of flamegraph.pl and speedscope."""
+
+    def __init__(self, thread_id, interval=0.01):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._sample, name='moobird-profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+
+    def _sample(self):
+        while self.running:
+            if frame := sys._current_frames().get(self.thread_id):
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                    frame = frame.f_back
+
+                self.stacks[tuple(reversed(stack))] += 1
+                self.samples += 1
+
+            time.sleep(self.interval)
+
+    def folded(self):
+        return '\n'.join(f"{';'.join(stack)} {count}" for stack, count in self.stacks.most_common()) + '\n'
+
+    def top(self, limit=15):
+        own = Counter()
+        cumulative = Counter()
+        busy = 0
+        for stack, count in self.stacks.items():
+            # Idle samples, where the loop is waiting on its selector, would drown out everything else
+            if stack[-1].startswith('selectors.py:'):
+                continue
+
+            busy += count
+            own[stack[-1]] += count
+            for function in set(stack):
+                cumulative[function] += count
+
+        total = busy or 1
+        rows = [f'{busy} of {self.samples} samples busy', f"{'cum%':>6} {'self%':>6}  function"]
+        # Frames present in every busy sample are the loop itself (run_forever, _run_once, ...)
+        hot = ((function, count) for function, count in cumulative.most_common() if count < busy or own[function])
+        for function, count in list(hot)[:limit]:
+            rows.append(f'{count * 100 / total:>6.1f} {own[function] * 100 / total:>6.1f}  {function}')
+
+        return '\n'.join(rows)
+
+class TracingProfiler:
+    """cProfile session over the event loop thread; deterministic, but with more overhead than sampling"""
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def dump(self):
+        # Same bytes as pstats.Stats.dump_stats(); open with flameprof or snakeviz
+        return marshal.dumps(pstats.Stats(self.profile).stats)
+
+    def top(self, limit=15):
+        output = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=output)
+        stats.strip_dirs().sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+
+        # Skip the preamble pstats prints before the table
+        lines = output.getvalue().splitlines()
+        start = next((i for i, line in enumerate(lines) if line.lstrip().startswith('ncalls')), 0)
+        return '\n'.join(line.rstrip() for line in lines[start:] if line.strip())
+
+async def run_profiler(profiler, seconds):
+    profiler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.stop()
+
+    return profiler
@@ -0,0 +1,80 @@
+import asyncio
+
+import discord
+import telemetry
+from scheduler import TokenBucket
+
+class WebhookRelay:
+    """Posts stream messages through a webhook the bot keeps in each stream channel.
+
+    Webhook messages don't count against the bot's own global and per-channel limits, so a busy stream no longer
+    delays votes and command replies. Each channel has its own queue and bucket; the returned message is bound to
+    the bot's connection so it can still seed reactions."""
+    name = 'MooBird Stream'
+    limit = (5, 2)  # Discord allows about 5 webhook messages per 2 seconds
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.webhooks = {}
+        self.queues = {}
+        self.buckets = {}
+        self.workers = {}
+
+    def owns(self, message: discord.Message):
+        return any(message.webhook_id == webhook.id for webhook in self.webhooks.values())
+
+    async def webhook(self, channel: discord.TextChannel) -> discord.Webhook:
+        if webhook := self.webhooks.get(channel.id):
+            return webhook
+
+        for webhook in await channel.webhooks():
+            if webhook.name == self.name and webhook.user and webhook.user.id == self.bot.user.id:
+                break
+        else:
+            webhook = await channel.create_webhook(name=self.name, reason='Stream delivery')
+
+        self.webhooks[channel.id] = webhook
+        return webhook
+
+    async def send(self, channel: discord.TextChannel, content):
+        if channel.id not in self.queues:
+            self.queues[channel.id] = asyncio.Queue()
+            self.buckets[channel.id] = TokenBucket(*self.limit)
+            self.workers[channel.id] = self.bot.loop.create_task(self._run(channel))
+
+        future = self.bot.loop.create_future()
+        self.queues[channel.id].put_nowait((content, future))
+        telemetry.webhook_queue.set(self.queues[channel.id].qsize(), channel=channel.id)
+        return await future
+
+    async def _run(self, channel):
+        queue, bucket = self.queues[channel.id], self.buckets[channel.id]
+        while True:
+            content, future = await queue.get()
+            telemetry.webhook_queue.set(queue.qsize(), channel=channel.id)
+            if future.done():
+                continue
+
+            if wait := bucket.available_in():
+                await asyncio.sleep(wait)
+
+            bucket.take()
+            try:
+                webhook = await self.webhook(channel)
+                sent = await webhook.send(content, wait=True, username=self.bot.user.name,
+                                          avatar_url=str(self.bot.user.avatar_url))
+            except discord.NotFound as e:
+                # Deleted in the channel settings; a new one is created for the next post
+                self.webhooks.pop(channel.id, None)
+                if not future.done():
+                    future.set_exception(e)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(channel.get_partial_message(sent.id))
+
+    def stop(self):
+        for worker in self.workers.values():
+            worker.cancel()
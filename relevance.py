@@ -0,0 +1,157 @@
+import heapq
+import itertools
+import re
+import zlib
+
+import telemetry
+from rules import CASHTAG
+
+TOKEN = re.compile(r'[#$@]?\w+')
+
+np = None  # NumPy, imported the first time relevance ranking is used; False if it isn't installed
+
+def available():
+    global np
+    if np is None:
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            np = False
+
+    return np is not False
+
+class GuildModel:
+    """What a guild's voters have liked so far, as hashed term counts and per-author history.
+
+    Terms are hashed into `dimensions` buckets so every batch is one dense matrix, whatever the vocabulary."""
+    dimensions = 4096
+    weights = {'similarity': 0.6, 'author': 0.3, 'cashtags': 0.1}
+
+    def __init__(self):
+        available()
+        self.df = np.zeros(self.dimensions)
+        self.docs = 0
+        self.liked = np.zeros(self.dimensions)
+        self.authors = {}
+
+    def _counts(self, texts):
+        counts = np.zeros((len(texts), self.dimensions))
+        tokens = [TOKEN.findall(text.lower()) for text in texts]
+        rows = np.fromiter((row for row, words in enumerate(tokens) for _ in words), dtype=np.intp)
+        columns = np.fromiter((zlib.crc32(word.encode()) % self.dimensions for words in tokens for word in words), dtype=np.intp)
+        np.add.at(counts, (rows, columns), 1)
+        return counts, np.array([len(words) for words in tokens], dtype=float)
+
+    def _idf(self):
+        return np.log((1 + self.docs) / (1 + self.df)) + 1
+
+    @staticmethod
+    def _normalize(matrix):
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+    def score(self, texts, authors):
+        """Scores a batch of Tweets between 0 and 1; also counts them towards the document frequencies"""
+        counts, lengths = self._counts(texts)
+        self.df += (counts > 0).sum(axis=0)
+        self.docs += len(texts)
+
+        idf = self._idf()
+        similarity = self._normalize(counts * idf) @ self._normalize(self.liked * idf)
+
+        # Laplace-smoothed share of an author's posted Tweets that were liked; unknown authors start at 0.5
+        history = np.array([self.authors.get(author, (0, 0)) for author in authors], dtype=float).reshape(-1, 2)
+        author = (history[:, 0] + 1) / (history[:, 1] + 2)
+
+        cashtags = np.array([len(CASHTAG.findall(text)) for text in texts], dtype=float)
+        density = np.minimum(1, 4 * cashtags / np.maximum(lengths, 1))
+
+        return (self.weights['similarity'] * similarity + self.weights['author'] * author
+                + self.weights['cashtags'] * (1 - density))
+
+    def posted(self, author):
+        likes, posts = self.authors.get(author, (0, 0))
+        self.authors[author] = (likes, posts + 1)
+
+    def learn(self, text, author, liked):
+        likes, posts = self.authors.get(author, (0, 0))
+        if liked:
+            counts, _ = self._counts([text])
+            self.liked += self._normalize(counts)[0]
+            self.authors[author] = (likes + 1, max(posts, likes + 1))
+        else:
+            # Muted authors are filtered anyway; their history just stops counting in their favour
+            self.authors[author] = (0, posts)
+
+class RelevanceStage:
+    """Holds each guild's matched Tweets for a window and only lets the best `top` of them through.
+
+    Tweets are scored in micro-batches as they arrive, so a busy window never lands on the event loop all at once;
+    a bounded heap keeps the best so far."""
+
+    def __init__(self, loop, publish, discard=None, batch_interval=2.0):
+        self.loop = loop
+        self.publish = publish
+        self.discard = discard
+        self.batch_interval = batch_interval
+        self.models = {}
+        self.pending = {}
+        self.best = {}
+        self.batches = {}
+        self.windows = {}
+        self.counter = itertools.count()
+
+    def model(self, guild_id) -> GuildModel:
+        if guild_id not in self.models:
+            self.models[guild_id] = GuildModel()
+
+        return self.models[guild_id]
+
+    def submit(self, guild_id, channel, item, top, window):
+        self.pending.setdefault(guild_id, []).append((channel, item))
+        if guild_id not in self.batches:
+            self.batches[guild_id] = self.loop.call_later(self.batch_interval, self._score, guild_id, top)
+        if guild_id not in self.windows:
+            self.windows[guild_id] = self.loop.call_later(window, self._release, guild_id, top)
+
+    def _score(self, guild_id, top):
+        self.batches.pop(guild_id, None)
+        if not (batch := self.pending.pop(guild_id, None)):
+            return
+
+        scores = self.model(guild_id).score([item['text'] for _, item in batch], [item['tweet_author'] for _, item in batch])
+        best = self.best.setdefault(guild_id, [])
+        for (channel, item), score in zip(batch, scores):
+            entry = (float(score), next(self.counter), channel, item)
+            if len(best) < top:
+                heapq.heappush(best, entry)
+            else:
+                _, _, dropped_channel, dropped = heapq.heappushpop(best, entry)
+                telemetry.stream_messages.inc(guild=guild_id, stage='outranked')
+                if self.discard:
+                    self.discard(dropped_channel, dropped)
+
+    def _release(self, guild_id, top):
+        self.windows.pop(guild_id, None)
+        if timer := self.batches.get(guild_id):
+            timer.cancel()
+        self._score(guild_id, top)
+
+        if best := sorted(self.best.pop(guild_id, []), reverse=True):
+            self.loop.create_task(self._publish_all(guild_id, best))
+
+    async def _publish_all(self, guild_id, best):
+        model = self.model(guild_id)
+        for score, _, channel, item in best:
+            model.posted(item['tweet_author'])
+            item['score'] = round(score, 3)
+            await self.publish(channel, item)
+
+    def learn(self, guild_id, text, author, liked):
+        if text is not None and available():
+            self.model(guild_id).learn(text, author, liked)
+
+    def stop(self):
+        for timer in (*self.batches.values(), *self.windows.values()):
+            timer.cancel()
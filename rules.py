@@ -0,0 +1,142 @@
+import re
+from collections import Counter
+
+CASHTAG = re.compile(r'\$[A-Za-z][A-Za-z0-9_]*')
+DEFAULT_CASHTAG_LIMIT = 15
+# Numbered backreferences and conditionals; group numbers shift once a pattern joins the others
+NUMBERED_REFERENCE = re.compile(r'(?<!\\)(?:\\\\)*\\[1-9]|\(\?\(\d')
+# Words that need no quoting in Twitter's search syntax
+PLAIN_WORD = re.compile(r'[#@$]?\w+')
+
+SYNTAX = {
+    '@user'       : 'Tweets by this account',
+    're:<pattern>': 'Regular expression (case-insensitive)',
+    'word:<term>' : 'Whole word or phrase',
+    'cashtags:<n>': 'More than n cashtags',
+    'quote:<text>': 'Text in the quoted Tweet',
+    '<text>'      : 'Text anywhere in the Tweet',
+}
+
+def search_word(word):
+    if PLAIN_WORD.fullmatch(word) and word.upper() not in ('OR', 'AND'):
+        return word
+
+    return '"' + word.replace('"', '') + '"'
+
+def search_term(term):
+    """A stream term in search syntax; as with the v1.1 stream's `track`, a term's words may appear in any order"""
+    words = [search_word(word) for word in term.split()]
+    return words[0] if len(words) == 1 else f"({' '.join(words)})"
+
+def search_query(terms):
+    return ' OR '.join(search_term(term) for term in terms if term.split())
+
+def parse(entry: str):
+    """Splits an ignore entry into (kind, value); raises ValueError for entries that cannot compile"""
+    if entry.startswith('@'):
+        return 'author', entry[1:].lower()
+
+    kind, sep, value = entry.partition(':')
+    if not sep or kind not in ('re', 'word', 'cashtags', 'quote') or not value:
+        return 'text', entry
+
+    if kind == 're':
+        if NUMBERED_REFERENCE.search(value):
+            raise ValueError(f'Numbered backreferences are not supported in `{value}`')
+
+        try:
+            # Compiled the way Matcher combines it, so flags like `(?i)` that only work at the very start fail here
+            compiled = re.compile(f'(?:)|(?P<r>{value})')
+        except re.error as e:
+            raise ValueError(f'Invalid pattern `{value}`: {e.msg}' + (
+                '. Use a scoped flag like `(?i:...)` instead' if 'global flags' in e.msg else ''))
+
+        if set(compiled.groupindex) != {'r'}:
+            raise ValueError(f'Named groups are not supported in `{value}`')
+
+    if kind == 'cashtags' and not value.isdigit():
+        raise ValueError(f'`{entry}` needs a number, e.g. `cashtags:10`')
+
+    return kind, value
+
+class Matcher:
+    """Every ignore rule of a guild compiled into one pass over the Tweet text and one over the quoted text"""
+
+    def __init__(self, entries, hits=None):
+        self.entries = tuple(entries)
+        self.hits = hits if hits is not None else Counter()
+        self.authors = {}
+        self.cashtag_limit = None
+        self.cashtag_entry = None
+
+        text_patterns = []
+        quote_patterns = []
+        self.groups = {}
+        self.skipped = []
+
+        for entry in self.entries:
+            try:
+                kind, value = parse(entry)
+            except ValueError as e:
+                print(f'Skipping ignore rule `{entry}`.', e)
+                self.skipped.append(entry)
+                continue
+
+            if kind == 'author':
+                self.authors[value] = entry
+                # Mentions of a muted account are ignored too, as plain `@user` entries always have been
+                kind, value = 'text', entry
+
+            if kind == 'cashtags':
+                if self.cashtag_limit is None or int(value) < self.cashtag_limit:
+                    self.cashtag_limit, self.cashtag_entry = int(value), entry
+            else:
+                group = f'r{len(self.groups)}'
+                self.groups[group] = entry
+                pattern = {'re': value, 'word': rf'\b{re.escape(value)}\b'}.get(kind, re.escape(value))
+                (quote_patterns if kind == 'quote' else text_patterns).append((group, f'(?P<{group}>{pattern})'))
+
+        self.text = self._combine(text_patterns)
+        self.quote = self._combine(quote_patterns)
+
+    def _combine(self, patterns):
+        if not patterns:
+            return None
+
+        try:
+            return re.compile('|'.join(pattern for _, pattern in patterns), re.IGNORECASE)
+        except re.error:
+            pass
+
+        # One rule spoils the combined pattern; find it rather than lose every rule
+        kept = []
+        for group, pattern in patterns:
+            try:
+                re.compile('|'.join(kept + [pattern]), re.IGNORECASE)
+                kept.append(pattern)
+            except re.error as e:
+                print(f'Skipping ignore rule `{self.groups[group]}`.', e)
+                self.skipped.append(self.groups[group])
+
+        return re.compile('|'.join(kept), re.IGNORECASE) if kept else None
+
+    def match(self, author, text, quoted_text=''):
+        """Returns the ignore entry that matched, or None"""
+        if entry := self.authors.get(author.lower()):
+            return self._hit(entry)
+
+        if self.text and (found := self.text.search(text)):
+            return self._hit(self.groups[found.lastgroup])
+
+        if self.quote and quoted_text and (found := self.quote.search(quoted_text)):
+            return self._hit(self.groups[found.lastgroup])
+
+        limit = DEFAULT_CASHTAG_LIMIT if self.cashtag_limit is None else self.cashtag_limit
+        if '$' in text and len(CASHTAG.findall(text)) > limit:
+            return self._hit(self.cashtag_entry or f'cashtags:{DEFAULT_CASHTAG_LIMIT}')
+
+        return None
+
+    def _hit(self, entry):
+        self.hits[entry] += 1
+        return entry
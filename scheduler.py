@@ -0,0 +1,174 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import time
+from functools import partial
+
+import telemetry
+
+# Write endpoints rarely return x-rate-limit-* headers; these are Twitter's documented caps (requests, window seconds)
+DEFAULT_LIMITS = {
+    'statuses/update'     : (300, 10800),
+    'statuses/retweet/:id': (300, 10800),
+    'favorites/create'    : (1000, 86400),
+    'media/upload'        : (1000, 900),
+}
+
+class TokenBucket:
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.tokens = float(limit)
+        self.updated = time.time()
+        self.blocked_until = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.limit, self.tokens + (now - self.updated) * self.limit / self.window)
+        self.updated = now
+
+    def seed(self, limits):
+        """Adopt the server's view of the window from x-rate-limit-* headers, unless that window is already over"""
+        now = time.time()
+        if limits['reset'] and limits['reset'] <= now:
+            return
+
+        self.limit = limits['limit'] or self.limit
+        self.tokens = float(limits['remaining'])
+        self.updated = now
+        if limits['remaining'] <= 0 and limits['reset'] > now:
+            self.blocked_until = limits['reset']
+
+    def block(self, until):
+        self.tokens = 0.0
+        self.updated = time.time()
+        self.blocked_until = max(self.blocked_until, until)
+
+    def available_in(self, needed=1, now=None):
+        now = now or time.time()
+        self._refill(now)
+
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens + 1e-9 < needed:
+            wait = max(wait, (needed - self.tokens) * self.window / self.limit)
+
+        return wait
+
+    def take(self):
+        self._refill(time.time())
+        self.tokens -= 1
+
+class ActionScheduler:
+    """Queues Twitter write calls for one account and sends them as its rate limits allow.
+
+    Lower priority values go first, so voted Tweets are not held up behind a backlog of likes. Calls run in the
+    default executor so a slow request never blocks the event loop; with a `work` scheduler they also wait for
+    their guild's fair share, but only once the rate limit allows them to be sent."""
+    VOTE = 0
+    RETWEET = 1
+    LIKE = 2
+
+    def __init__(self, api, loop, work=None):
+        self.api = api
+        self.loop = loop
+        self.work = work
+        self.queue = []
+        self.buckets = {}
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.worker = loop.create_task(self._run())
+
+    def bucket(self, endpoint):
+        if endpoint not in self.buckets:
+            self.buckets[endpoint] = TokenBucket(*DEFAULT_LIMITS.get(endpoint, (15, 900)))
+            if limits := getattr(self.api, 'rate_limits', {}).get(endpoint):
+                self.buckets[endpoint].seed(limits)
+
+        return self.buckets[endpoint]
+
+    def submit(self, endpoint, function, *args, priority=LIKE, guild_id=0, **kwargs):
+        """Queues `function(*args, **kwargs)`; returns a future for its result"""
+        future = self.loop.create_future()
+        item = (priority, next(self.counter), endpoint, partial(function, *args, **kwargs), contextvars.copy_context(), future, guild_id)
+        heapq.heappush(self.queue, item)
+        telemetry.queued_actions.set(len(self.queue), account=telemetry.account_of(self.api))
+        self.wakeup.set()
+
+        return future
+
+    async def call(self, endpoint, function, *args, priority=LIKE, guild_id=0, **kwargs):
+        return await self.submit(endpoint, function, *args, priority=priority, guild_id=guild_id, **kwargs)
+
+    def eta(self, endpoint, priority=LIKE):
+        """Seconds until a call to `endpoint` submitted now at `priority` is expected to be sent"""
+        bucket = self.bucket(endpoint)
+        ahead = sum(1 for item in self.queue if item[2] == endpoint and item[0] <= priority)
+        return bucket.available_in(ahead + 1)
+
+    async def _run(self):
+        while True:
+            if not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            # Highest priority entry whose endpoint has capacity; entries for exhausted endpoints wait their turn
+            now = time.time()
+            ready = None
+            soonest = None
+            for item in sorted(self.queue):
+                wait = self.bucket(item[2]).available_in(now=now)
+                if wait <= 0:
+                    ready = item
+                    break
+                soonest = wait if soonest is None else min(soonest, wait)
+
+            if ready is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=soonest)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self.queue.remove(ready)
+            heapq.heapify(self.queue)
+            telemetry.queued_actions.set(len(self.queue), account=telemetry.account_of(self.api))
+            await self._execute(ready)
+
+    async def _execute(self, item):
+        import tweepy
+
+        priority, _, endpoint, function, context, future, guild_id = item
+        if future.cancelled():
+            return
+
+        bucket = self.bucket(endpoint)
+        bucket.take()
+        rate_limits = getattr(self.api, 'rate_limits', {})
+        previous = rate_limits.get(endpoint)
+        try:
+            if self.work:
+                result = await self.work.run(guild_id, 'twitter', self.loop.run_in_executor, None, partial(context.run, function))
+            else:
+                result = await self.loop.run_in_executor(None, partial(context.run, function))
+        except tweepy.TooManyRequests as e:
+            reset = int(e.response.headers.get('x-rate-limit-reset', 0)) or time.time() + 60
+            bucket.block(reset)
+            # Keep its place in line rather than failing the vote
+            heapq.heappush(self.queue, item)
+            return
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        finally:
+            # Only headers from this response; an old entry may be left over from a 429 long ago
+            if (limits := rate_limits.get(endpoint)) is not None and limits is not previous:
+                bucket.seed(limits)
+
+        if not future.done():
+            future.set_result(result)
+
+    def stop(self):
+        self.worker.cancel()
@@ -0,0 +1,207 @@
+import bisect
+import re
+import time
+from collections import defaultdict
+
+from tracing import tracer
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def _format_labels(self, key, extra=None):
+        pairs = list(zip(self.labels, key))
+        if extra:
+            pairs.append(extra)
+
+        if not pairs:
+            return ''
+
+        return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in pairs) + '}'
+
+    def samples(self):
+        return []
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self.samples())
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, doc, labels=()):
+        super().__init__(name, doc, labels)
+        self.values = defaultdict(float)
+
+    def inc(self, value=1, **labels):
+        self.values[self._key(labels)] += value
+
+    def samples(self):
+        return [f'{self.name}{self._format_labels(key)} {value}' for key, value in self.values.items()]
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, doc, labels=()):
+        super().__init__(name, doc, labels)
+        self.values = {}
+        self.function = None
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def set_function(self, function):
+        """Compute the value at scrape time. `function` returns a number, or a dict of label tuples to numbers."""
+        self.function = function
+
+    def samples(self):
+        values = self.values
+        if self.function:
+            result = self.function()
+            values = result if isinstance(result, dict) else {(): result}
+
+        return [f'{self.name}{self._format_labels(key)} {value}' for key, value in values.items()]
+
+class Histogram(Metric):
+    kind = 'histogram'
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, doc, labels=(), buckets=None):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets or self.default_buckets)
+        self.counts = {}
+        self.sums = defaultdict(float)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        counts = self.counts.setdefault(key, [0] * (len(self.buckets) + 1))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[key] += value
+
+    def samples(self):
+        lines = []
+        for key, counts in self.counts.items():
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                lines.append(f'{self.name}_bucket{self._format_labels(key, ("le", bound))} {total}')
+            lines.append(f'{self.name}_sum{self._format_labels(key)} {self.sums[key]}')
+            lines.append(f'{self.name}_count{self._format_labels(key)} {total}')
+
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric):
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, doc, labels=()):
+        return self._register(Counter(name, doc, labels))
+
+    def gauge(self, name, doc, labels=()):
+        return self._register(Gauge(name, doc, labels))
+
+    def histogram(self, name, doc, labels=(), buckets=None):
+        return self._register(Histogram(name, doc, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+discord_latency = registry.histogram('moobird_discord_request_seconds', 'Discord API request latency by route', ('route',))
+twitter_latency = registry.histogram('moobird_twitter_request_seconds', 'Twitter API request latency by endpoint', ('endpoint',))
+twitter_rate_remaining = registry.gauge('moobird_twitter_rate_limit_remaining', 'Remaining Twitter requests in the current window', ('account', 'endpoint'))
+stream_messages = registry.counter('moobird_stream_messages_total', 'Stream messages by guild and stage (received, filtered, posted)', ('guild', 'stage'))
+open_candidates = registry.gauge('moobird_open_candidates', 'Votes and interactions currently awaiting reactions')
+config_flushes = registry.counter('moobird_config_flushes_total', 'Writes of config.yaml')
+loop_lag = registry.gauge('moobird_event_loop_lag_seconds', 'Delay between scheduled and actual wake-up of the event loop')
+errors = registry.counter('moobird_errors_total', 'Errors caught and reported by handlers', ('where',))
+stream_resume = registry.gauge('moobird_stream_resume_seconds', 'Time from startup until every enabled stream was reconnected')
+queued_actions = registry.gauge('moobird_queued_actions', 'Twitter write actions waiting for rate-limit capacity', ('account',))
+guild_queue_depth = registry.gauge('moobird_guild_queue_depth', "Jobs waiting in each guild's fair-share queue", ('guild',))
+guild_queue_time = registry.histogram('moobird_guild_queue_seconds', "Time jobs wait for their guild's turn, by kind of work", ('guild', 'kind'))
+config_reload = registry.gauge('moobird_config_reload_seconds', 'Time taken to apply the last edit of config.yaml')
+webhook_queue = registry.gauge('moobird_webhook_queue', 'Stream posts waiting for their channel webhook', ('channel',))
+extension_load = registry.gauge('moobird_extension_load_seconds', 'Time spent loading each extension, split into import and setup', ('extension', 'phase'))
+
+def account_of(api):
+    # Access tokens are prefixed with the numeric id of the account they belong to
+    return str(api.auth.access_token).split('-')[0]
+
+def endpoint_of(endpoint):
+    # statuses/retweet/123 -> statuses/retweet/:id, so limits and labels are per endpoint rather than per Tweet
+    return re.sub(r'/\d+', '/:id', endpoint)
+
+def record_rate_limit(api, endpoint, response):
+    if response is None or 'x-rate-limit-remaining' not in response.headers:
+        return
+
+    limits = {
+        'limit'    : int(response.headers.get('x-rate-limit-limit', 0)),
+        'remaining': int(response.headers['x-rate-limit-remaining']),
+        'reset'    : int(response.headers.get('x-rate-limit-reset', 0)),
+    }
+    api.rate_limits[endpoint] = limits
+    twitter_rate_remaining.set(limits['remaining'], account=account_of(api), endpoint=endpoint)
+
+def instrument_api(api):
+    """Time every request made through `api` and keep its latest rate-limit headers in `api.rate_limits`."""
+    import tweepy
+
+    if hasattr(api, 'rate_limits'):
+        return api
+
+    api.rate_limits = {}
+    request = api.request
+
+    def timed_request(method, endpoint, *args, **kwargs):
+        label = endpoint_of(endpoint)
+        start = time.perf_counter()
+        response = None
+        try:
+            with tracer.span(f'twitter {label}'):
+                result = request(method, endpoint, *args, **kwargs)
+            response = getattr(api, 'last_response', None)
+            return result
+        except tweepy.HTTPException as e:
+            response = e.response
+            raise
+        finally:
+            twitter_latency.observe(time.perf_counter() - start, endpoint=label)
+            record_rate_limit(api, label, response)
+
+    api.request = timed_request
+    return api
+
+def instrument_http(http):
+    """Time every Discord REST call made through the bot's HTTPClient, labelled by route template."""
+    request = http.request
+
+    async def timed_request(route, **kwargs):
+        start = time.perf_counter()
+        try:
+            with tracer.span(f'discord {route.method} {route.path}'):
+                return await request(route, **kwargs)
+        finally:
+            discord_latency.observe(time.perf_counter() - start, route=f'{route.method} {route.path}')
+
+    http.request = timed_request
+    return http
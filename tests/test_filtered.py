@@ -0,0 +1,178 @@
+"""FilteredStream against a local stand-in for Twitter's v2 filtered-stream endpoints"""
+import asyncio
+import contextlib
+import itertools
+import json
+from unittest.mock import AsyncMock
+
+import pytest
+
+pytest.importorskip('tweepy.asynchronous')
+aiohttp = pytest.importorskip('aiohttp')
+from aiohttp import web
+
+from filtered import FilteredStream, build_rule
+
+class StandIn:
+    """Just enough of api.twitter.com: the stream rules endpoints and a stream sending whatever is pushed to it"""
+
+    def __init__(self):
+        self.rules = {}
+        self.ids = itertools.count(1)
+        self.added = []
+        self.deleted = []
+        self.tweets = asyncio.Queue()
+        self.app = web.Application()
+        self.app.router.add_get('/2/tweets/search/stream/rules', self.get_rules)
+        self.app.router.add_post('/2/tweets/search/stream/rules', self.post_rules)
+        self.app.router.add_get('/2/tweets/search/stream', self.stream)
+
+    async def get_rules(self, request):
+        data = [{'id': rule_id, 'value': value, 'tag': tag} for rule_id, (value, tag) in self.rules.items()]
+        return web.json_response({'data': data, 'meta': {'result_count': len(data)}} if data else {'meta': {'result_count': 0}})
+
+    async def post_rules(self, request):
+        body = await request.json()
+        if 'add' in body:
+            created = []
+            for rule in body['add']:
+                rule_id = str(next(self.ids))
+                self.rules[rule_id] = (rule['value'], rule['tag'])
+                self.added.append((rule['value'], rule['tag']))
+                created.append({'id': rule_id, **rule})
+            return web.json_response({'data': created, 'meta': {'summary': {'created': len(created)}}})
+
+        for rule_id in body['delete']['ids']:
+            self.deleted.append(self.rules.pop(str(rule_id)))
+        return web.json_response({'meta': {'summary': {'deleted': len(body['delete']['ids'])}}})
+
+    async def stream(self, request):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        while True:
+            try:
+                tweet = await asyncio.wait_for(self.tweets.get(), timeout=1)
+            except asyncio.TimeoutError:
+                await response.write(b'\r\n')  # Keep-alive
+                continue
+            await response.write(json.dumps(tweet).encode() + b'\r\n')
+
+@contextlib.asynccontextmanager
+async def stand_in(monkeypatch):
+    server = StandIn()
+    runner = web.AppRunner(server.app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+
+    request = aiohttp.ClientSession._request
+
+    def to_stand_in(session, method, url, **kwargs):
+        return request(session, method, str(url).replace('https://api.twitter.com', f'http://{host}:{port}'), **kwargs)
+
+    monkeypatch.setattr(aiohttp.ClientSession, '_request', to_stand_in)
+    client = FilteredStream('bearer')
+    try:
+        yield server, client
+    finally:
+        client.disconnect()
+        if client.session is not None:
+            await client.session.close()
+        await runner.cleanup()
+
+def attach(client, guild_id, terms, ignore=(), callback=None):
+    search = {'terms': list(terms), 'ignore': list(ignore)}
+    stream = client.attach(guild_id, f'moo{guild_id}', f'channel{guild_id}', callback or AsyncMock(), lambda: search)
+    return stream, search
+
+def test_build_rule():
+    # Like v1.1 `track`, the words of a term match in any order rather than as an exact phrase
+    assert build_rule(['beefy', 'bear market', 'moo.fi'], [], 'moobird') == \
+        '(beefy OR (bear market) OR "moo.fi") -is:retweet -is:reply -from:moobird'
+
+    rule = build_rule(['beefy'], ['@spammer', 'word:scam', 'airdrop scam', 're:air.?drop', 'cashtags:5'], 'moobird')
+    assert rule.endswith('-from:moobird -from:spammer -scam -"airdrop scam"')
+
+    with pytest.raises(ValueError):
+        build_rule(['x' * 600], [], 'moobird')
+
+def test_sync_adds_a_rule_per_guild(monkeypatch):
+    async def scenario():
+        async with stand_in(monkeypatch) as (server, client):
+            attach(client, 1, ['beefy'])
+            attach(client, 2, ['cow'], ['@bull'])
+
+            assert await client.sync() == (2, 0)
+            assert set(server.rules.values()) == {(build_rule(['beefy'], [], 'moo1'), '1'),
+                                                  (build_rule(['cow'], ['@bull'], 'moo2'), '2')}
+
+            # Nothing differs, so nothing is sent
+            assert await client.sync() == (0, 0)
+            assert len(server.added) == 2
+
+    asyncio.run(scenario())
+
+def test_sync_changes_only_the_edited_rule(monkeypatch):
+    async def scenario():
+        async with stand_in(monkeypatch) as (server, client):
+            attach(client, 1, ['beefy'])
+            _, search = attach(client, 2, ['cow'])
+            await client.sync()
+            kept = next(rule_id for rule_id, (_, tag) in server.rules.items() if tag == '1')
+
+            search['ignore'].append('word:scam')
+            assert await client.sync() == (1, 1)
+
+            assert server.deleted == [(build_rule(['cow'], [], 'moo2'), '2')]
+            assert server.rules[kept] == (build_rule(['beefy'], [], 'moo1'), '1')
+            assert (build_rule(['cow'], ['word:scam'], 'moo2'), '2') in server.rules.values()
+
+    asyncio.run(scenario())
+
+def test_disconnect_removes_the_rule_and_the_last_closes_the_connection(monkeypatch):
+    async def scenario():
+        async with stand_in(monkeypatch) as (server, client):
+            first, _ = attach(client, 1, ['beefy'])
+            second, _ = attach(client, 2, ['cow'])
+            await client.sync()
+            await asyncio.wait_for(client.connected.wait(), timeout=5)
+
+            await first.disconnect()
+            assert [tag for _, tag in server.rules.values()] == ['2']
+            assert not client.task.done()
+
+            await second.disconnect()
+            assert server.rules == {}
+            await asyncio.sleep(0.1)
+            assert client.task.done()
+
+    asyncio.run(scenario())
+
+def test_stream_delivers_to_the_matching_guild(monkeypatch):
+    async def scenario():
+        async with stand_in(monkeypatch) as (server, client):
+            first, _ = attach(client, 1, ['beefy'])
+            second, _ = attach(client, 2, ['cow'])
+            await client.sync()
+            await asyncio.wait_for(client.connected.wait(), timeout=5)
+
+            rule_id = next(rule_id for rule_id, (_, tag) in server.rules.items() if tag == '2')
+            await server.tweets.put({
+                'data': {'id': '10', 'text': 'moo', 'author_id': '20', 'edit_history_tweet_ids': ['10']},
+                'includes': {'users': [{'id': '20', 'name': 'Cow', 'username': 'cow'}]},
+                'matching_rules': [{'id': rule_id, 'tag': '2'}],
+            })
+
+            for _ in range(50):
+                if second.callback.await_count:
+                    break
+                await asyncio.sleep(0.05)
+
+            first.callback.assert_not_awaited()
+            second.callback.assert_awaited_once()
+            channel, status = second.callback.await_args.args
+            assert channel == 'channel2'
+            assert (status.id, status.text, status.author.screen_name) == (10, 'moo', 'cow')
+
+    asyncio.run(scenario())
@@ -0,0 +1,96 @@
+"""Concurrent reactions on one candidate must carry its action out exactly once"""
+import asyncio
+import time
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+pytest.importorskip('discord')
+
+from commands.twitter import Twitter
+from mooBird import MooBird
+
+GUILD_ID = 42
+VOTE_ID = 1000
+
+def make_cog(candidates, votes_needed=1):
+    cog = Twitter.__new__(Twitter)  # Without the cleanup loop and relevance stage __init__ starts
+    cog.bot = SimpleNamespace(
+        tweet_candidates=candidates,
+        config={GUILD_ID: {'votes_needed': votes_needed}},
+        response_options=MooBird.response_options,
+        interaction_options=MooBird.interaction_options,
+        analytics=MagicMock(),
+        get_cog=lambda name: None,
+    )
+    cog.check_permission = AsyncMock(return_value=True)
+    return cog
+
+def make_message(message_id):
+    users = SimpleNamespace(flatten=AsyncMock(return_value=[]))
+    reactions = [SimpleNamespace(users=lambda: users) for _ in range(3)]
+
+    message = MagicMock()
+    message.id = message_id
+    message.guild.id = GUILD_ID
+    message.channel.fetch_message = AsyncMock(return_value=SimpleNamespace(reactions=reactions))
+    message.channel.send = AsyncMock()
+    message.delete = AsyncMock()
+    message.clear_reaction = AsyncMock()
+    return message
+
+def react(message, emoji, count):
+    return SimpleNamespace(emoji=emoji, count=count, message=message)
+
+def test_concurrent_votes_post_once():
+    vote = make_message(VOTE_ID)
+    candidates = {VOTE_ID: {'action': 'tweet', 'votes': {}, 'message': make_message(1), 'proposed': time.time(),
+                            'status': None, 'trace': None}}
+    cog = make_cog(candidates)
+    update_status = MagicMock()
+
+    async def send_tweet(message_id, message_info):
+        # A slow update_status, so the other reactions arrive while it runs
+        await asyncio.sleep(0.01)
+        update_status(message_info['message'].id)
+        message_info['status'] = SimpleNamespace(id=1)
+        del cog.bot.tweet_candidates[message_id]  # KeyError if a second run got this far
+        return 'https://twitter.com/moo/status/1'
+
+    cog._send_tweet = send_tweet
+
+    async def main():
+        return await asyncio.gather(*(cog._handle_reaction(react(vote, '👍', count), SimpleNamespace(id=count), candidates[VOTE_ID])
+                                      for count in range(2, 22)), return_exceptions=True)
+
+    results = asyncio.run(main())
+
+    assert not [result for result in results if isinstance(result, Exception)]
+    update_status.assert_called_once_with(1)
+    vote.delete.assert_awaited_once()
+    assert VOTE_ID not in candidates
+    assert all('error' not in str(call) for call in vote.channel.send.await_args_list)
+
+def test_concurrent_interactions_act_once():
+    stream_post = make_message(VOTE_ID)
+    candidate = {'action': 'interact', 'votes': {}, 'message': stream_post, 'tweet_id': 7, 'tweet_author': 'cow',
+                 'trace': None}
+    cog = make_cog({VOTE_ID: candidate})
+
+    async def action(ctx, candidate, voters, action):
+        await asyncio.sleep(0.01)
+
+    cog._action = AsyncMock(side_effect=action)
+    like = MooBird.interaction_options[0]
+
+    async def main():
+        return await asyncio.gather(*(cog._handle_reaction(react(stream_post, like, count), SimpleNamespace(id=count), candidate)
+                                      for count in range(2, 22)), return_exceptions=True)
+
+    results = asyncio.run(main())
+
+    assert not [result for result in results if isinstance(result, Exception)]
+    cog._action.assert_awaited_once()
+    assert cog._action.await_args.args[3] == 'favorite'
+    assert candidate['flights'] == {'favorite': 'done'}
@@ -0,0 +1,115 @@
+import contextlib
+import contextvars
+import json
+import time
+import uuid
+from collections import OrderedDict
+
+current_trace = contextvars.ContextVar('current_trace', default=None)
+current_span = contextvars.ContextVar('current_span', default=None)
+
+class Tracer:
+    """Collects spans sharing a correlation id, from stream receipt or proposal through to the Twitter call.
+
+    Spans of the most recent traces are kept in memory for the owner `trace` command, and are appended to a
+    JSONL file when `tracing.path` is configured."""
+
+    def __init__(self, path=None, keep=500):
+        self.path = path
+        self.keep = keep
+        self.traces = OrderedDict()
+        self.links = OrderedDict()
+        self.file = None
+
+    def configure(self, enabled=True, path=None, keep=500):
+        self.path = path if enabled else None
+        self.keep = keep
+
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    @staticmethod
+    def new_trace():
+        return uuid.uuid4().hex[:16]
+
+    @staticmethod
+    def current():
+        return current_trace.get()
+
+    def link(self, key, trace_id):
+        """Associate a Discord message id (vote or stream post) with a trace so it can be looked up later"""
+        if trace_id:
+            self.links[key] = trace_id
+            self._trim(self.links)
+
+    def resolve(self, key):
+        """Accepts a trace id or a linked message id"""
+        if key in self.traces:
+            return key
+
+        if str(key).isdigit():
+            return self.links.get(int(key))
+
+        return self.links.get(key)
+
+    @contextlib.contextmanager
+    def span(self, name, trace_id=None, **attributes):
+        trace_id = trace_id or current_trace.get()
+        if not trace_id:
+            yield None
+            return
+
+        span = {
+            'trace_id' : trace_id,
+            'span_id'  : uuid.uuid4().hex[:8],
+            'parent_id': current_span.get() if current_trace.get() == trace_id else None,
+            'name'     : name,
+            'start'    : time.time(),
+            'duration' : None,
+            'status'   : 'ok',
+            **attributes
+        }
+
+        trace_token = current_trace.set(trace_id)
+        span_token = current_span.set(span['span_id'])
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span['status'] = type(e).__name__
+            raise
+        finally:
+            span['duration'] = time.perf_counter() - start
+            current_span.reset(span_token)
+            current_trace.reset(trace_token)
+            self._export(span)
+
+    def _export(self, span):
+        self.traces.setdefault(span['trace_id'], []).append(span)
+        self.traces.move_to_end(span['trace_id'])
+        self._trim(self.traces)
+
+        if not self.path:
+            return
+
+        try:
+            if not self.file:
+                self.file = open(self.path, 'a', buffering=1)
+            self.file.write(json.dumps(span, default=str) + '\n')
+        except OSError as e:
+            print('Failed to export span', e)
+
+    def _trim(self, mapping):
+        while len(mapping) > self.keep:
+            mapping.popitem(last=False)
+
+    def breakdown(self, trace_id):
+        spans = sorted(self.traces.get(trace_id, []), key=lambda s: s['start'])
+        if not spans:
+            return []
+
+        origin = spans[0]['start']
+        return [(s['name'], s['start'] - origin, s['duration'], s['status']) for s in spans]
+
+tracer = Tracer()